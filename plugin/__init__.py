@@ -21,6 +21,8 @@ from .commands import (
     CopilotConversationInsertCodeShimCommand,
     CopilotConversationRatingCommand,
     CopilotConversationRatingShimCommand,
+    CopilotConversationShowOlderTurnsCommand,
+    CopilotConversationSwitchCommand,
     CopilotConversationTemplatesCommand,
     CopilotConversationToggleReferencesBlockCommand,
     CopilotConversationTurnDeleteCommand,
@@ -33,6 +35,8 @@ from .commands import (
     CopilotPreviousCompletionCommand,
     CopilotRejectCompletionCommand,
     CopilotSendAnyRequestCommand,
+    CopilotShowConversationReferencesCommand,
+    CopilotShowMetricsCommand,
     CopilotSignInCommand,
     CopilotSignInWithGithubTokenCommand,
     CopilotSignOutCommand,
@@ -66,6 +70,8 @@ __all__ = (
     "CopilotConversationInsertCodeShimCommand",
     "CopilotConversationRatingCommand",
     "CopilotConversationRatingShimCommand",
+    "CopilotConversationShowOlderTurnsCommand",
+    "CopilotConversationSwitchCommand",
     "CopilotConversationTemplatesCommand",
     "CopilotConversationToggleReferencesBlockCommand",
     "CopilotConversationTurnDeleteCommand",
@@ -77,6 +83,8 @@ __all__ = (
     "CopilotPreviousCompletionCommand",
     "CopilotRejectCompletionCommand",
     "CopilotSendAnyRequestCommand",
+    "CopilotShowConversationReferencesCommand",
+    "CopilotShowMetricsCommand",
     "CopilotSignInCommand",
     "CopilotSignInWithGithubTokenCommand",
     "CopilotSignOutCommand",
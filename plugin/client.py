@@ -3,19 +3,25 @@ from __future__ import annotations
 import functools
 import json
 import os
+import time
 import weakref
 from collections.abc import Callable
 from dataclasses import dataclass
 from functools import wraps
-from typing import Any, cast
+from itertools import takewhile
+from operator import itemgetter
+from typing import Any, Hashable, cast
 from urllib.parse import urlparse
 
 import jmespath
 import sublime
 from LSP.plugin import ClientConfig, DottedDict, Notification, Request, Session, WorkspaceFolder
 from lsp_utils import ApiWrapperInterface, NpmClientHandler, notification_handler, request_handler
+from more_itertools import ilen, unique_everseen
 
 from .constants import (
+    ERR_CONTENT_MODIFIED,
+    ERR_REQUEST_CANCELLED,
     NTFY_FEATURE_FLAGS_NOTIFICATION,
     NTFY_LOG_MESSAGE,
     NTFY_PANEL_SOLUTION,
@@ -31,16 +37,26 @@ from .constants import (
 )
 from .helpers import (
     ActivityIndicator,
+    AdaptiveDelay,
+    CompletionCache,
     CopilotIgnore,
     GithubInfo,
+    ReferenceCollector,
+    TelemetryQueue,
+    get_context_window_region,
     prepare_completion_request_doc,
+    prepare_next_line_request_doc,
     preprocess_completions,
     preprocess_panel_completions,
+    shift_lsp_range_lines,
 )
-from .log import log_warning
+from .log import log_error, log_warning
+from .metrics import Metrics
 from .template import load_string_template
 from .types import (
     AccountStatus,
+    CopilotDocType,
+    CopilotPayloadCompletion,
     CopilotPayloadCompletions,
     CopilotPayloadConversationContext,
     CopilotPayloadFeatureFlagsNotification,
@@ -52,12 +68,13 @@ from .types import (
     NetworkProxy,
     T_Callable,
 )
-from .ui import ViewCompletionManager, ViewPanelCompletionManager, WindowConversationManager
+from .ui import ViewCompletionManager, ViewPanelCompletionManager, WindowChatPanel, WindowConversationManager
 from .utils import (
     all_views,
     all_windows,
     debounce,
     get_session_setting,
+    get_view_language_id,
     status_message,
 )
 
@@ -123,6 +140,9 @@ class CopilotPlugin(NpmClientHandler):
 
     _activity_indicator: ActivityIndicator | None = None
 
+    completion_delay = AdaptiveDelay()
+    """Decides the debounce delay of completion requests. It's shared because it models the user."""
+
     def __init__(self, session: weakref.ref[Session]) -> None:
         super().__init__(session)
 
@@ -130,6 +150,13 @@ class CopilotPlugin(NpmClientHandler):
             self.window_attrs[sess.window].client = self
 
         self._activity_indicator = ActivityIndicator(self.update_status_bar_text)
+        self._completion_request_ids: dict[int, set[int]] = {}
+        """Per-view IDs of in-flight completion requests. Only accessed from the async thread."""
+        self.completion_cache = CompletionCache()
+        self._prefetch_cache_keys: set[Hashable] = set()
+        """Cache keys of speculatively prefetched completions which haven't been used yet."""
+        self.reference_collector = ReferenceCollector()
+        self.telemetry = TelemetryQueue(self._send_telemetry)
 
         # Note that ST persists view settings after ST is closed. If the user closes ST
         # during awaiting Copilot's response, the internal state management will be corrupted.
@@ -139,13 +166,14 @@ class CopilotPlugin(NpmClientHandler):
             ViewPanelCompletionManager(view).reset()
 
         for window in all_windows():
-            WindowConversationManager(window).reset()
+            WindowChatPanel(window).reset()
 
     @classmethod
     def setup(cls) -> None:
         super().setup()
 
         cls.server_version = cls.parse_server_version()
+        sublime.set_timeout_async(WindowConversationManager.expire_transcripts)
 
     @classmethod
     def cleanup(cls) -> None:
@@ -201,6 +229,9 @@ class CopilotPlugin(NpmClientHandler):
 
         super().on_settings_changed(settings)
 
+        # settings such as "context_window" affect completions
+        self.completion_cache.clear()
+
         if not (session := self.weaksession()):
             return
 
@@ -303,6 +334,142 @@ class CopilotPlugin(NpmClientHandler):
         session = self.weaksession()
         return bool(session and session.session_view_for_view_async(view))
 
+    def synced_doc_version(self, view: sublime.View) -> int | None:
+        """
+        The version of the document of `view` which has been synced to the server.
+        If "incremental_doc_sync" is disabled or the document is not synced, returns `None`.
+        """
+        if not ((session := self.weaksession()) and get_session_setting(session, "incremental_doc_sync")):
+            return None
+        if not (session_view := session.session_view_for_view_async(view)):
+            return None
+        # make sure pending "textDocument/didChange" notifications have been sent
+        if listener := session_view.listener():
+            listener.purge_changes_async()
+        return session_view.session_buffer.version
+
+    def context_window_region(self, view: sublime.View) -> sublime.Region | None:
+        """
+        The region around the caret which should be sent as the document, according to the "context_window"
+        setting. If there is no limit for the view's language, returns `None`.
+        """
+        if not ((session := self.weaksession()) and len(sel := view.sel())):
+            return None
+
+        limits_map: dict[str, dict[str, int]] = get_session_setting(session, "context_window") or {}
+        limits = {**limits_map.get("*", {}), **limits_map.get(get_view_language_id(view), {})}
+        if not any(limits.values()):
+            return None
+
+        return get_context_window_region(
+            view,
+            sel[0].begin(),
+            lines_before=int(limits.get("lines_before", 0)),
+            lines_after=int(limits.get("lines_after", 0)),
+            chars_before=int(limits.get("chars_before", 0)),
+            chars_after=int(limits.get("chars_after", 0)),
+        )
+
+    def prepare_request_doc(
+        self,
+        view: sublime.View,
+        *,
+        context_region: sublime.Region | None = None,
+    ) -> CopilotDocType | None:
+        """
+        Prepare the `doc` param for `view`. If `context_region` is given, only that part of the document is sent.
+        Otherwise, the `source` is omitted if the server has the same version already.
+        """
+        return prepare_completion_request_doc(
+            view,
+            synced_version=self.synced_doc_version(view),
+            context_region=context_region,
+        )
+
+    def send_doc_request_async(
+        self,
+        view: sublime.View,
+        request: Request,
+        on_result: Callable[[Any], None],
+        *,
+        on_error: Callable[[Any], None] | None = None,
+        on_request_id: Callable[[int], None] | None = None,
+    ) -> int | None:
+        """
+        Send a `request` whose params contain a `doc` and return the request ID.
+
+        If the `doc` has no `source` and the server responds that its copy of the document is not the same version,
+        the request will be re-sent with the full text. Other errors are logged and passed to `on_error`,
+        so that callers can stop waiting for the result. `on_request_id` is called with the ID of every sent
+        request, including the re-sent one, so that callers can cancel whichever is in flight.
+        """
+        if not (session := self.weaksession()):
+            return None
+
+        def send(request: Request) -> int | None:
+            request_id = session.send_request_async(request, on_result, handle_error)
+            if request_id is not None and on_request_id:
+                on_request_id(request_id)
+            return request_id
+
+        def handle_error(error: Any) -> None:
+            doc: CopilotDocType = request.params["doc"]
+            if (
+                "source" not in doc
+                and isinstance(error, dict)
+                and error.get("code") == ERR_CONTENT_MODIFIED
+                and view.is_valid()
+            ):
+                Metrics.increase("doc_sync.fallbacks")
+                Metrics.increase("doc_sync.bytes_saved", -view.size())
+                doc["source"] = view.substr(sublime.Region(0, view.size()))
+                doc["version"] = view.change_count()
+                send(Request(request.method, request.params))
+                return
+
+            if not (isinstance(error, dict) and error.get("code") == ERR_REQUEST_CANCELLED):
+                log_error(f'Request "{request.method}" failed: {error}')
+            if on_error:
+                on_error(error)
+
+        return send(request)
+
+    def stop_panel_completions(self, vcm: ViewPanelCompletionManager, *, generation: int | None = None) -> None:
+        """
+        Stops waiting for panel completions of `vcm` and marks the panel done.
+        Solutions which arrive later are dropped since they belong to a superseded generation.
+        If `generation` is given, only that generation is stopped.
+        """
+        if not vcm.is_waiting:
+            return
+        if generation is None:
+            vcm.new_generation()
+        elif not vcm.supersede(generation):
+            return
+
+        self.cancel_panel_completions_request(vcm)
+        vcm.is_waiting = False
+        vcm.update(immediately=True)
+
+    def cancel_panel_completions_request(self, vcm: ViewPanelCompletionManager) -> None:
+        """Cancels the in-flight `getPanelCompletions` request of `vcm`, if any."""
+        if (request_id := vcm.request_id) is not None and (session := self.weaksession()):
+            session.cancel_request(request_id)
+            Metrics.increase("panel_completion.cancelled")
+        vcm.request_id = None
+
+    def _has_enough_panel_completions(self, vcm: ViewPanelCompletionManager) -> bool:
+        """Whether there are `min_solutions` unique panel completions whose scores are at least `min_score`."""
+        if not (session := self.weaksession()):
+            return False
+        policy = get_session_setting(session, "panel_completion_early_stop") or {}
+        if not (min_solutions := policy.get("min_solutions", 0)):
+            return False
+        min_score = policy.get("min_score", 0)
+        # completions are ranked by score so the qualified ones are a prefix
+        qualified = takewhile(lambda pair: pair[1]["score"] >= min_score, vcm.ranked_completions())
+        return ilen(qualified) >= min_solutions
+
     def update_status_bar_text(self, extra_variables: dict[str, Any] | None = None) -> None:
         if not (session := self.weaksession()):
             return
@@ -328,9 +495,8 @@ class CopilotPlugin(NpmClientHandler):
             if (
                 (token := notification.params["token"]).startswith("copilot_chat://")
                 and (params := notification.params["value"])
-                and (window := WindowConversationManager.find_window_by_token_id(token))
+                and (wcm := WindowConversationManager.from_token(token))
             ):
-                wcm = WindowConversationManager(window)
                 if params.get("kind", None) == "end":
                     wcm.is_waiting = False
 
@@ -344,7 +510,11 @@ class CopilotPlugin(NpmClientHandler):
                     message = followup.get("message", "")
                     wcm.follow_up = message
 
-                wcm.update()
+                # the final render must not be dropped
+                if is_end := params.get("kind", None) == "end":
+                    wcm.snapshot()
+
+                wcm.update(immediately=is_end)
 
     @notification_handler(NTFY_FEATURE_FLAGS_NOTIFICATION)
     def _handle_feature_flags_notification(self, payload: CopilotPayloadFeatureFlagsNotification) -> None:
@@ -356,23 +526,27 @@ class CopilotPlugin(NpmClientHandler):
 
     @notification_handler(NTFY_PANEL_SOLUTION)
     def _handle_panel_solution_notification(self, payload: CopilotPayloadPanelSolution) -> None:
-        if not (view := ViewPanelCompletionManager.find_view_by_panel_id(payload["panelId"])):
+        if not (vcm := ViewPanelCompletionManager.from_panel_id(payload["panelId"])):
             return
 
-        preprocess_panel_completions(view, [payload])
+        generation = vcm.generation
+        preprocess_panel_completions(vcm.view, [payload], line_offset=vcm.line_offset)
 
-        vcm = ViewPanelCompletionManager(view)
-        vcm.append_completion(payload)
+        # the request is stopped as soon as the threshold is reached rather than after all solutions
+        if vcm.append_completion(payload) and self._has_enough_panel_completions(vcm):
+            self.stop_panel_completions(vcm, generation=generation)
+            Metrics.increase("panel_completion.early_stops")
+            return
         vcm.update()
 
     @notification_handler(NTFY_PANEL_SOLUTION_DONE)
     def _handle_panel_solution_done_notification(self, payload) -> None:
-        if not (view := ViewPanelCompletionManager.find_view_by_panel_id(payload["panelId"])):
+        if not (vcm := ViewPanelCompletionManager.from_panel_id(payload["panelId"])):
             return
 
-        vcm = ViewPanelCompletionManager(view)
+        vcm.request_id = None
         vcm.is_waiting = False
-        vcm.update()
+        vcm.update(immediately=True)
 
     @notification_handler(NTFY_STATUS_NOTIFICATION)
     def _handle_status_notification_notification(self, payload: CopilotPayloadStatusNotification) -> None:
@@ -387,41 +561,254 @@ class CopilotPlugin(NpmClientHandler):
         respond(None)  # what?
 
     @_guard_view()
-    @debounce()
+    @debounce(lambda: CopilotPlugin.completion_delay.delay())
     def request_get_completions(self, view: sublime.View) -> None:
+        # the cache may have been filled (e.g., by prefetching) during debouncing
+        if self.show_cached_completions(view):
+            return
+
+        if (session := self.weaksession()) and get_session_setting(session, "lazy_completion_cycling"):
+            # alternatives will be fetched when the user cycles completions
+            self._request_completions(view, REQ_GET_COMPLETIONS)
+            return
+
         self._request_completions(view, REQ_GET_COMPLETIONS, no_callback=True)
         self._request_completions(view, REQ_GET_COMPLETIONS_CYCLING)
 
+    @_guard_view(failed_return=False)
+    def show_cached_completions(self, view: sublime.View, *, record_miss: bool = True) -> bool:
+        """
+        Show completions for the current cursor position from the cache. Returns whether it's a cache hit.
+        A miss isn't recorded unless `record_miss`, for a lookup which is followed by another one on a miss.
+        """
+        if not ((session := self.weaksession()) and len(sel := view.sel()) == 1):
+            return False
+
+        cache_key = CompletionCache.make_key(view, sel[0])
+        if (cached := self.completion_cache.get(cache_key)) is None:
+            if record_miss:
+                Metrics.increase("completion_cache.misses")
+            return False
+
+        Metrics.increase("completion_cache.hits")
+        if cache_key in self._prefetch_cache_keys:
+            self._prefetch_cache_keys.discard(cache_key)
+            Metrics.increase("prefetch.hits")
+        completions, has_fetched_cycling = cached
+        vcm = ViewCompletionManager(view)
+        vcm.has_fetched_cycling = has_fetched_cycling
+        vcm.show(completions, 0, get_session_setting(session, "completion_style"))
+        self._record_shown_completion(vcm)
+        return True
+
+    def _record_shown_completion(self, vcm: ViewCompletionManager) -> None:
+        if vcm.is_visible and (completion := vcm.current_completion):
+            self.telemetry.shown(completion["uuid"])
+
+    def _send_telemetry(self, request: str, payload: dict[str, Any]) -> None:
+        if (session := self.weaksession()) and get_session_setting(session, "telemetry"):
+            Metrics.increase("telemetry.requests")
+            session.send_request_async(Request(request, payload), lambda _: None)
+
+    def prefetch_next_line_async(self, view: sublime.View, point: int) -> None:
+        """
+        Speculatively request completions for the next line as if a newline had been typed at `point`,
+        and cache them so that they show up immediately if the user does so.
+        """
+        if not (self.weaksession() and view.is_valid()):
+            return
+
+        context_region = self.context_window_region(view)
+        line_offset = view.rowcol(context_region.begin())[0] if context_region else 0
+        doc, indentation = prepare_next_line_request_doc(view, point, context_region=context_region)
+        row = doc["position"]["line"]
+        new_line_begin = point + 1
+        cache_key = CompletionCache.make_text_key(
+            view.buffer_id(),
+            sublime.Region(new_line_begin + len(indentation)),
+            view.substr(sublime.Region(max(0, point - CompletionCache.CHARS_BEFORE), point)) + "\n" + indentation,
+            "",
+            view.substr(sublime.Region(point, min(view.size(), point + CompletionCache.CHARS_AFTER))),
+        )
+
+        def on_result(payload: CopilotPayloadCompletions) -> None:
+            # the new line doesn't exist in the view yet so we can't use `preprocess_completions()`
+            completions: list[CopilotPayloadCompletion] = []
+            for completion in unique_everseen(payload["completions"], key=itemgetter("displayText")):
+                position, range_ = completion["position"], completion["range"]
+                if not (position["line"] == range_["start"]["line"] == range_["end"]["line"] == row):
+                    continue
+                completion["point"] = new_line_begin + position["character"]
+                completion["region"] = (
+                    new_line_begin + range_["start"]["character"],
+                    new_line_begin + range_["end"]["character"],
+                )
+                position["line"] += line_offset
+                shift_lsp_range_lines(range_, line_offset)
+                completions.append(completion)
+
+            if completions:
+                self.completion_cache.put(cache_key, completions)
+                if len(self._prefetch_cache_keys) >= self.completion_cache.max_size:
+                    self._prefetch_cache_keys.clear()
+                self._prefetch_cache_keys.add(cache_key)
+
+        Metrics.increase("prefetch.requests")
+        # not tracked for cancellation since the request is meant to outlive the next modification
+        self.send_doc_request_async(view, Request(REQ_GET_COMPLETIONS_CYCLING, {"doc": doc}), on_result)
+
+    def show_adjacent_completion(self, view: sublime.View, offset: int) -> None:
+        """
+        Show the completion which is `offset` away from the current one. In "lazy_completion_cycling" mode,
+        alternatives for the current position are fetched (only once) when this is called for the first time.
+        """
+        vcm = ViewCompletionManager(view)
+        if not (
+            (session := self.weaksession())
+            and get_session_setting(session, "lazy_completion_cycling")
+            and not vcm.has_fetched_cycling
+        ):
+            vcm.show(completion_index=vcm.completion_index + offset)
+            self._record_shown_completion(vcm)
+            return
+
+        vcm.has_fetched_cycling = True
+        sublime.set_timeout_async(lambda: self._request_cycling_completions_async(view, offset))
+
+    def _request_cycling_completions_async(self, view: sublime.View, offset: int) -> None:
+        if len(sel := view.sel()) != 1:
+            return
+
+        region = sel[0].to_tuple()
+        cache_key = CompletionCache.make_key(view, sel[0])
+
+        def on_result(payload: CopilotPayloadCompletions, line_offset: int) -> None:
+            vcm = ViewCompletionManager(view)
+            # the shown completion has gone stale during awaiting Copilot's response
+            if not (vcm.is_visible and len(sel := view.sel()) == 1 and sel[0].to_tuple() == region):
+                return
+
+            preprocess_completions(view, alternatives := payload["completions"], line_offset=line_offset)
+            completions = vcm.completions
+            display_texts = {completion["displayText"] for completion in completions}
+            completions.extend(filter(lambda completion: completion["displayText"] not in display_texts, alternatives))
+            self.completion_cache.put(cache_key, completions, has_fetched_cycling=True)
+            vcm.show(completions, vcm.completion_index + offset)
+            self._record_shown_completion(vcm)
+
+        if not self._send_completion_request_async(view, REQ_GET_COMPLETIONS_CYCLING, on_result):
+            vcm = ViewCompletionManager(view)
+            vcm.show(completion_index=vcm.completion_index + offset)
+            self._record_shown_completion(vcm)
+
     def _request_completions(self, view: sublime.View, request: str, *, no_callback: bool = False) -> None:
         vcm = ViewCompletionManager(view)
         vcm.hide()
 
         if not (
-            (session := self.weaksession())
+            self.weaksession()
             and self._account_status.has_signed_in
             and self._account_status.is_authorized
             and len(sel := view.sel()) == 1
         ):
             return
 
-        if not (doc := prepare_completion_request_doc(view)):
-            return
-
         if no_callback:
-            callback = lambda _: None  # noqa: E731
+            callback: Callable[[CopilotPayloadCompletions, int], None] = lambda *_: None  # noqa: E731
         else:
+            callback = functools.partial(
+                self._on_get_completions,
+                view,
+                region=sel[0].to_tuple(),
+                cache_key=CompletionCache.make_key(view, sel[0]),
+                has_fetched_cycling=request == REQ_GET_COMPLETIONS_CYCLING,
+            )
+
+        def on_error() -> None:
+            # the result callback won't be called for a failed request
+            vcm.is_waiting = False
+            if self._activity_indicator:
+                self._activity_indicator.stop()
+
+        if no_callback:
+            self._send_completion_request_async(view, request, callback)
+        elif self._send_completion_request_async(view, request, callback, on_error=on_error):
             vcm.is_waiting = True
             if self._activity_indicator:
                 self._activity_indicator.start()
-            callback = functools.partial(self._on_get_completions, view, region=sel[0].to_tuple())
 
-        session.send_request_async(Request(request, {"doc": doc}), callback)
+    def _send_completion_request_async(
+        self,
+        view: sublime.View,
+        request: str,
+        callback: Callable[[CopilotPayloadCompletions, int], None],
+        *,
+        on_error: Callable[[], None] | None = None,
+    ) -> bool:
+        """
+        Send a completion `request` for the cursor position of `view`. The `callback` is called with the payload
+        and the line offset of the sent document (see `preprocess_completions()`), or `on_error` is called if
+        the request fails. Returns whether it's sent.
+        """
+        context_region = self.context_window_region(view)
+        if not (doc := self.prepare_request_doc(view, context_region=context_region)):
+            return False
+
+        line_offset = view.rowcol(context_region.begin())[0] if context_region else 0
+
+        # the original request and its re-sent one if the server's document is not the same version
+        request_ids: list[int] = []
+
+        def on_request_id(request_id: int) -> None:
+            request_ids.append(request_id)
+            self._completion_request_ids.setdefault(view.id(), set()).add(request_id)
+
+        def on_result(payload: CopilotPayloadCompletions) -> None:
+            self._completion_request_ids.get(view.id(), set()).difference_update(request_ids)
+            Metrics.increase("completions.completed")
+            self.completion_delay.record_latency(time.perf_counter() - sent_time)
+            callback(payload, line_offset)
+
+        def on_request_error(error: Any) -> None:
+            self._completion_request_ids.get(view.id(), set()).difference_update(request_ids)
+            Metrics.increase("completions.failed")
+            if on_error:
+                on_error()
+
+        sent_time = time.perf_counter()
+        request_id = self.send_doc_request_async(
+            view,
+            Request(request, {"doc": doc}),
+            on_result,
+            on_error=on_request_error,
+            on_request_id=on_request_id,
+        )
+        return request_id is not None
+
+    def cancel_completion_requests_async(self, view: sublime.View) -> int:
+        """Cancel in-flight completion requests for `view` because they are stale. Returns the cancelled count."""
+        if not (request_ids := self._completion_request_ids.pop(view.id(), None)):
+            return 0
+
+        if session := self.weaksession():
+            for request_id in request_ids:
+                session.cancel_request(request_id)
+        Metrics.increase("completions.cancelled", len(request_ids))
+
+        # the response callback won't be called for a cancelled request
+        ViewCompletionManager(view).is_waiting = False
+        if self._activity_indicator:
+            self._activity_indicator.stop()
+        return len(request_ids)
 
     def _on_get_completions(
         self,
         view: sublime.View,
         payload: CopilotPayloadCompletions,
+        line_offset: int,
         region: tuple[int, int],
+        cache_key: Hashable,
+        has_fetched_cycling: bool,
     ) -> None:
         vcm = ViewCompletionManager(view)
         vcm.is_waiting = False
@@ -442,5 +829,8 @@ class CopilotPlugin(NpmClientHandler):
         if not (completions := payload["completions"]):
             return
 
-        preprocess_completions(view, completions)
+        preprocess_completions(view, completions, line_offset=line_offset)
+        self.completion_cache.put(cache_key, completions, has_fetched_cycling=has_fetched_cycling)
+        vcm.has_fetched_cycling = has_fetched_cycling
         vcm.show(completions, 0, get_session_setting(session, "completion_style"))
+        self._record_shown_completion(vcm)
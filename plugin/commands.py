@@ -33,8 +33,6 @@ from .constants import (
     REQ_GET_PANEL_COMPLETIONS,
     REQ_GET_PROMPT,
     REQ_GET_VERSION,
-    REQ_NOTIFY_ACCEPTED,
-    REQ_NOTIFY_REJECTED,
     REQ_SIGN_IN_CONFIRM,
     REQ_SIGN_IN_INITIATE,
     REQ_SIGN_IN_WITH_GITHUB_TOKEN,
@@ -43,12 +41,12 @@ from .constants import (
 from .decorators import must_be_active_view
 from .helpers import (
     GithubInfo,
-    prepare_completion_request_doc,
     prepare_conversation_turn_request,
     preprocess_chat_message,
     preprocess_message_for_html,
 )
 from .log import log_info
+from .metrics import Metrics
 from .types import (
     CopilotConversationDebugTemplates,
     CopilotPayloadConversationCreate,
@@ -56,8 +54,6 @@ from .types import (
     CopilotPayloadConversationTemplate,
     CopilotPayloadFileStatus,
     CopilotPayloadGetVersion,
-    CopilotPayloadNotifyAccepted,
-    CopilotPayloadNotifyRejected,
     CopilotPayloadPanelCompletionSolutionCount,
     CopilotPayloadSignInConfirm,
     CopilotPayloadSignInInitiate,
@@ -66,7 +62,7 @@ from .types import (
     CopilotUserDefinedPromptTemplates,
     T_Callable,
 )
-from .ui import ViewCompletionManager, ViewPanelCompletionManager, WindowConversationManager
+from .ui import ViewCompletionManager, ViewPanelCompletionManager, WindowChatPanel, WindowConversationManager
 from .utils import (
     find_index_by_key_value,
     find_view_by_id,
@@ -136,17 +132,6 @@ class CopilotTextCommand(BaseCopilotCommand, LspTextCommand, ABC):
     def want_event(self) -> bool:
         return False
 
-    def _record_telemetry(
-        self,
-        session: Session,
-        request: str,
-        payload: CopilotPayloadNotifyAccepted | CopilotPayloadNotifyRejected,
-    ) -> None:
-        if not get_session_setting(session, "telemetry"):
-            return
-
-        session.send_request(Request(request, payload), lambda _: None)
-
     @must_be_active_view(failed_return=False)
     @_provide_plugin_session(failed_return=False)
     def is_enabled(self, plugin: CopilotPlugin, session: Session) -> bool:  # type: ignore
@@ -218,8 +203,7 @@ class CopilotConversationChatShimCommand(CopilotWindowCommand):
         if not (window := find_window_by_id(window_id)):
             return
 
-        wcm = WindowConversationManager(window)
-        if not (view := find_view_by_id(wcm.last_active_view_id)):
+        if not (view := find_view_by_id(WindowChatPanel(window).last_active_view_id)):
             return
 
         # Focus the view so that the command runs
@@ -229,33 +213,42 @@ class CopilotConversationChatShimCommand(CopilotWindowCommand):
 
 class CopilotToggleConversationChatCommand(CopilotWindowCommand):
     def run(self) -> None:
-        if not (wcm := WindowConversationManager(self.window)):
-            return
-
-        if wcm.is_visible:
-            wcm.close()
+        chat_panel = WindowChatPanel(self.window)
+        if chat_panel.is_visible:
+            chat_panel.close()
         elif view := self.window.active_view():
             view.run_command("copilot_conversation_chat")
 
 
 class CopilotConversationChatCommand(CopilotTextCommand):
     @_provide_plugin_session()
-    def run(self, plugin: CopilotPlugin, session: Session, _: sublime.Edit, message: str = "") -> None:
+    def run(
+        self,
+        plugin: CopilotPlugin,
+        session: Session,
+        _: sublime.Edit,
+        message: str = "",
+        new: bool = False,
+    ) -> None:
         if not (window := self.view.window()):
             return
 
-        wcm = WindowConversationManager(window)
+        if new or not (wcm := WindowConversationManager.find(window)):
+            wcm = WindowConversationManager.create(window)
         if wcm.conversation_id:
             wcm.open()
-            wcm.prompt(callback=lambda msg: self._on_prompt(plugin, session, msg), initial_text=message)
+            wcm.prompt(callback=lambda msg: self._on_prompt(plugin, session, msg, wcm.key), initial_text=message)
             return
 
+        if new and wcm.is_visible:
+            wcm.update(immediately=True)
+
         session.send_request(
             Request(
                 REQ_CONVERSATION_PRECONDITIONS,
                 {},
             ),
-            lambda response: self._on_result_conversation_preconditions(plugin, session, response, message),
+            lambda response: self._on_result_conversation_preconditions(plugin, session, response, message, wcm.key),
         )
 
     def _on_result_conversation_preconditions(
@@ -264,11 +257,14 @@ class CopilotConversationChatCommand(CopilotTextCommand):
         session: Session,
         payload: CopilotPayloadConversationPreconditions,
         initial_message: str,
+        key: str,
     ) -> None:
         if not (window := self.view.window()):
             return
 
-        wcm = WindowConversationManager(window)
+        if not (wcm := WindowConversationManager.find(window, key)):
+            return
+
         if not (view := find_view_by_id(wcm.last_active_view_id)):
             return
 
@@ -294,12 +290,12 @@ class CopilotConversationChatCommand(CopilotTextCommand):
                         "allSkills": True,
                         "skills": [],
                     },
-                    "workDoneToken": f"copilot_chat://{window.id()}",
+                    "workDoneToken": wcm.work_done_token,
                     "computeSuggestions": True,
                     "source": "panel",
                 },
             ),
-            lambda msg: self._on_result_conversation_create(plugin, session, msg),
+            lambda msg: self._on_result_conversation_create(plugin, session, msg, key),
         )
         wcm.is_waiting = True
         wcm.update()
@@ -309,30 +305,60 @@ class CopilotConversationChatCommand(CopilotTextCommand):
         plugin: CopilotPlugin,
         session: Session,
         payload: CopilotPayloadConversationCreate,
+        key: str,
     ) -> None:
         if not (window := self.view.window()):
             return
 
-        wcm = WindowConversationManager(window)
+        if not (wcm := WindowConversationManager.find(window, key)):
+            return
+
         wcm.conversation_id = payload["conversationId"]
         wcm.open()
-        wcm.prompt(callback=lambda msg: self._on_prompt(plugin, session, msg))
+        wcm.prompt(callback=lambda msg: self._on_prompt(plugin, session, msg, key))
 
-    def _on_prompt(self, plugin: CopilotPlugin, session: Session, msg: str):
+    def _on_prompt(self, plugin: CopilotPlugin, session: Session, msg: str, key: str):
         if not (window := self.view.window()):
             return
 
-        wcm = WindowConversationManager(window)
+        if not (wcm := WindowConversationManager.find(window, key)):
+            return
+
         if wcm.is_waiting:
-            wcm.prompt(callback=lambda x: self._on_prompt(plugin, session, x), initial_text=msg)
+            wcm.prompt(callback=lambda x: self._on_prompt(plugin, session, x, key), initial_text=msg)
+            return
+
+        sublime.set_timeout_async(lambda: self._send_turn_async(plugin, session, msg, key))
+
+    def _send_turn_async(self, plugin: CopilotPlugin, session: Session, msg: str, key: str) -> None:
+        if not (window := self.view.window()):
+            return
+
+        if not (wcm := WindowConversationManager.find(window, key)):
             return
 
         if not (view := find_view_by_id(wcm.last_active_view_id)):
             return
+        # the request is prepared here since syncing pending changes of the document must happen on the async thread
         user_prompts: list[CopilotUserDefinedPromptTemplates] = session.config.settings.get("prompts") or []
         is_template, msg = preprocess_chat_message(view, msg, user_prompts)
-        views = [sv.view for sv in session.session_views_async() if sv.view.id() != view.id()]
-        if not (request := prepare_conversation_turn_request(wcm.conversation_id, wcm.window.id(), msg, view, views)):
+        reference_limits = get_session_setting(session, "conversation_references") or {}
+        references = plugin.reference_collector.collect(
+            view,
+            (sv.view for sv in session.session_views_async()),
+            max_count=reference_limits.get("max_count", 20),
+            max_chars=reference_limits.get("max_chars", 100_000),
+        )
+        if not (
+            request := prepare_conversation_turn_request(
+                wcm.conversation_id,
+                wcm.work_done_token,
+                msg,
+                view,
+                list(references),
+                synced_version=plugin.synced_doc_version(view),
+            )
+        ):
             return
 
         wcm.append_conversation_entry({
@@ -345,13 +371,20 @@ class CopilotConversationChatCommand(CopilotTextCommand):
             "hideText": False,
             "warnings": [],
         })
-        session.send_request(
+        plugin.send_doc_request_async(
+            view,
             Request(REQ_CONVERSATION_TURN, request),
-            lambda _: wcm.prompt(callback=lambda x: self._on_prompt(plugin, session, x)),
+            lambda _: wcm.prompt(callback=lambda x: self._on_prompt(plugin, session, x, key)),
+            on_error=lambda _: self._on_error_conversation_turn(wcm),
         )
         wcm.is_waiting = True
         wcm.update()
 
+    def _on_error_conversation_turn(self, wcm: WindowConversationManager) -> None:
+        # no progress will be reported for a failed turn
+        wcm.is_waiting = False
+        wcm.update(immediately=True)
+
 
 class CopilotConversationCloseCommand(CopilotWindowCommand):
     def run(self, window_id: int | None = None) -> None:
@@ -360,13 +393,12 @@ class CopilotConversationCloseCommand(CopilotWindowCommand):
         if not (window := find_window_by_id(window_id)):
             return
 
-        WindowConversationManager(window).close()
+        WindowChatPanel(window).close()
 
 
 class CopilotConversationRatingShimCommand(CopilotWindowCommand):
     def run(self, turn_id: str, rating: int) -> None:
-        wcm = WindowConversationManager(self.window)
-        if not (view := find_view_by_id(wcm.last_active_view_id)):
+        if not (view := find_view_by_id(WindowChatPanel(self.window).last_active_view_id)):
             return
         # Focus the view so that the command runs
         self.window.focus_view(view)
@@ -397,8 +429,7 @@ class CopilotConversationRatingCommand(CopilotTextCommand):
 
 class CopilotConversationDestroyShimCommand(CopilotWindowCommand):
     def run(self, conversation_id: str) -> None:
-        wcm = WindowConversationManager(self.window)
-        if not (view := find_view_by_id(wcm.last_active_view_id)):
+        if not (view := find_view_by_id(WindowChatPanel(self.window).last_active_view_id)):
             status_message("Failed to find last active view.")
             return
         # Focus the view so that the command runs
@@ -410,9 +441,7 @@ class CopilotConversationDestroyCommand(CopilotTextCommand):
     @_provide_plugin_session()
     def run(self, plugin: CopilotPlugin, session: Session, _: sublime.Edit, conversation_id: str) -> None:
         if not (
-            (window := self.view.window())
-            and (wcm := WindowConversationManager(window))
-            and wcm.conversation_id == conversation_id
+            (window := self.view.window()) and WindowConversationManager.from_conversation_id(window, conversation_id)
         ):
             status_message("Failed to find window or conversation.")
             return
@@ -425,10 +454,10 @@ class CopilotConversationDestroyCommand(CopilotTextCommand):
                     "options": {},
                 },
             ),
-            self._on_result_conversation_destroy,
+            lambda payload: self._on_result_conversation_destroy(conversation_id, payload),
         )
 
-    def _on_result_conversation_destroy(self, payload: str) -> None:
+    def _on_result_conversation_destroy(self, conversation_id: str, payload: str) -> None:
         if not (window := self.view.window()):
             status_message("Failed to find window")
             return
@@ -437,30 +466,67 @@ class CopilotConversationDestroyCommand(CopilotTextCommand):
             return
 
         status_message("Destroyed conversation.")
-        wcm = WindowConversationManager(window)
-        wcm.close()
-        wcm.reset()
+        if wcm := WindowConversationManager.from_conversation_id(window, conversation_id):
+            wcm.destroy()
 
     def is_enabled(self, event: dict[Any, Any] | None = None, point: int | None = None) -> bool:  # type: ignore
         if not (window := self.view.window()):
             return False
-        return bool(WindowConversationManager(window).conversation_id)
+        return bool((wcm := WindowConversationManager.find(window)) and wcm.conversation_id)
 
 
 class CopilotConversationToggleReferencesBlockCommand(CopilotWindowCommand):
     def run(self, window_id: int, conversation_id: str, turn_id: str) -> None:
-        wcm = WindowConversationManager(self.window)
-        if conversation_id != wcm.conversation_id:
+        if not (wcm := WindowConversationManager.from_conversation_id(self.window, conversation_id)):
             return
 
         wcm.toggle_references_block(turn_id)
         wcm.update()
 
 
+class CopilotConversationSwitchCommand(CopilotWindowCommand):
+    def run(self) -> None:
+        conversations = WindowConversationManager.all_conversations(self.window)
+        items = [
+            sublime.QuickPanelItem(
+                wcm.suggested_title or "Untitled conversation",
+                annotation="⌛ streaming" if wcm.is_waiting else "",
+            )
+            for wcm in conversations
+        ]
+        selected_index = next((idx for idx, wcm in enumerate(conversations) if wcm.is_active), -1)
+        self.window.show_quick_panel(
+            items,
+            lambda index: self._on_selected(index, conversations),
+            selected_index=selected_index,
+        )
+
+    def _on_selected(self, index: int, conversations: list[WindowConversationManager]) -> None:
+        if index == -1:
+            return
+
+        wcm = conversations[index]
+        wcm.activate()
+        if wcm.is_visible:
+            wcm.update(immediately=True)
+        else:
+            wcm.open()
+
+
+class CopilotConversationShowOlderTurnsCommand(CopilotWindowCommand):
+    def run(self, window_id: int, key: str) -> None:
+        if not (wcm := WindowConversationManager.find(self.window, key)):
+            return
+
+        wcm.show_older_turns()
+        wcm.update(immediately=True)
+
+
 class CopilotConversationTurnDeleteShimCommand(CopilotWindowCommand):
     def run(self, window_id: int, conversation_id: str, turn_id: str) -> None:
-        wcm = WindowConversationManager(self.window)
-        if not (view := find_view_by_id(wcm.last_active_view_id)):
+        if not WindowConversationManager.from_conversation_id(self.window, conversation_id):
+            return
+        if not (view := find_view_by_id(WindowChatPanel(self.window).last_active_view_id)):
             return
         # Focus the view so that the command runs
         self.window.focus_view(view)
@@ -484,8 +550,7 @@ class CopilotConversationTurnDeleteCommand(CopilotTextCommand):
         if not (window := find_window_by_id(window_id)):
             return
 
-        wcm = WindowConversationManager(window)
-        if wcm.conversation_id != conversation_id:
+        if not (wcm := WindowConversationManager.from_conversation_id(window, conversation_id)):
             return
 
         # Fixes: https://github.com/TerminalFi/LSP-copilot/issues/181
@@ -520,8 +585,7 @@ class CopilotConversationTurnDeleteCommand(CopilotTextCommand):
         if not (window := find_window_by_id(window_id)):
             return
 
-        wcm = WindowConversationManager(window)
-        if wcm.conversation_id != conversation_id:
+        if not (wcm := WindowConversationManager.from_conversation_id(window, conversation_id)):
             return
 
         index = find_index_by_key_value(wcm.conversation, "turnId", turn_id)
@@ -529,6 +593,7 @@ class CopilotConversationTurnDeleteCommand(CopilotTextCommand):
         del conversation[index:]
         wcm.follow_up = ""
         wcm.conversation = conversation
+        wcm.snapshot()
         wcm.update()
 
     def is_enabled(self, event: dict[Any, Any] | None = None, point: int | None = None) -> bool:  # type: ignore
@@ -536,30 +601,28 @@ class CopilotConversationTurnDeleteCommand(CopilotTextCommand):
 
 
 class CopilotConversationCopyCodeCommand(CopilotWindowCommand):
-    def run(self, window_id: int, code_block_index: int) -> None:
+    def run(self, window_id: int, key: str, code_block_id: str) -> None:
         if not (window := find_window_by_id(window_id)):
             return
 
-        wcm = WindowConversationManager(window)
-        if not (code := wcm.code_block_index.get(str(code_block_index), None)):
+        if not ((wcm := WindowConversationManager.find(window, key)) and (code := wcm.code_block(code_block_id))):
             return
 
         sublime.set_clipboard(code)
 
 
 class CopilotConversationInsertCodeShimCommand(CopilotWindowCommand):
-    def run(self, window_id: int, code_block_index: int) -> None:
+    def run(self, window_id: int, key: str, code_block_id: str) -> None:
         if not (window := find_window_by_id(window_id)):
             status_message(f"Failed to find window based on ID. ({window_id})")
             return
 
-        wcm = WindowConversationManager(window)
-        if not (view := find_view_by_id(wcm.last_active_view_id)):
+        if not (view := find_view_by_id(WindowChatPanel(window).last_active_view_id)):
             status_message("Window has no active view")
             return
 
-        if not (code := wcm.code_block_index.get(str(code_block_index), None)):
-            status_message(f"Failed to find code based on index. {code_block_index}")
+        if not ((wcm := WindowConversationManager.find(window, key)) and (code := wcm.code_block(code_block_id))):
+            status_message(f"Failed to find code based on ID. ({code_block_id})")
             return
 
         # Focus the view so that the command runs
@@ -591,8 +654,15 @@ class CopilotConversationAgentsCommand(CopilotTextCommand):
 class CopilotGetPromptCommand(CopilotTextCommand):
     @_provide_plugin_session()
     def run(self, plugin: CopilotPlugin, session: Session, _: sublime.Edit) -> None:
-        doc = prepare_completion_request_doc(self.view)
-        session.send_request(Request(REQ_GET_PROMPT, {"doc": doc}), self._on_result_get_prompt)
+        sublime.set_timeout_async(lambda: self._send_request_async(plugin))
+
+    def _send_request_async(self, plugin: CopilotPlugin) -> None:
+        # the doc is prepared here since syncing pending changes of the document must happen on the async thread
+        context_region = plugin.context_window_region(self.view)
+        if not (doc := plugin.prepare_request_doc(self.view, context_region=context_region)):
+            return
+
+        plugin.send_doc_request_async(self.view, Request(REQ_GET_PROMPT, {"doc": doc}), self._on_result_get_prompt)
 
     def _on_result_get_prompt(self, payload) -> None:
         if not (window := self.view.window()):
@@ -663,12 +733,14 @@ class CopilotAcceptCompletionCommand(CopilotTextCommand):
         self.view.insert(edit, source_line_region.begin(), completion["text"])
         self.view.show(self.view.sel(), show_surrounds=False, animate=self.view.settings().get("animation_enabled"))
 
-        self._record_telemetry(session, REQ_NOTIFY_ACCEPTED, {"uuid": completion["uuid"]})
+        if get_session_setting(session, "prefetch_after_accept"):
+            inserted_end = source_line_region.begin() + len(completion["text"])
+            sublime.set_timeout_async(lambda: plugin.prefetch_next_line_async(self.view, inserted_end))
 
-        other_uuids = [completion["uuid"] for completion in vcm.completions]
-        other_uuids.remove(completion["uuid"])
-        if other_uuids:
-            self._record_telemetry(session, REQ_NOTIFY_REJECTED, {"uuids": other_uuids})
+        plugin.telemetry.accepted(completion["uuid"])
+        plugin.telemetry.rejected(
+            completion_["uuid"] for completion_ in vcm.completions if completion_["uuid"] != completion["uuid"]
+        )
 
 
 class CopilotRejectCompletionCommand(CopilotTextCommand):
@@ -677,42 +749,67 @@ class CopilotRejectCompletionCommand(CopilotTextCommand):
         vcm = ViewCompletionManager(self.view)
         vcm.hide()
 
-        self._record_telemetry(
-            session,
-            REQ_NOTIFY_REJECTED,
-            {"uuids": [completion["uuid"] for completion in vcm.completions]},
-        )
+        plugin.telemetry.rejected(completion["uuid"] for completion in vcm.completions)
 
 
 class CopilotGetPanelCompletionsCommand(CopilotTextCommand):
     @_provide_plugin_session()
     def run(self, plugin: CopilotPlugin, session: Session, _: sublime.Edit) -> None:
-        if not (doc := prepare_completion_request_doc(self.view)):
+        sublime.set_timeout_async(lambda: self._send_request_async(plugin, session))
+
+    def _send_request_async(self, plugin: CopilotPlugin, session: Session) -> None:
+        # the doc is prepared here since syncing pending changes of the document must happen on the async thread
+        context_region = plugin.context_window_region(self.view)
+        if not (doc := plugin.prepare_request_doc(self.view, context_region=context_region)):
             return
 
         vcm = ViewPanelCompletionManager(self.view)
+        # a previous request of this view is superseded so its remaining solutions are dropped
+        plugin.cancel_panel_completions_request(vcm)
+        generation = vcm.new_generation()
         vcm.is_waiting = True
         vcm.is_visible = True
         vcm.completions = []
+        vcm.line_offset = self.view.rowcol(context_region.begin())[0] if context_region else 0
 
         params = {"doc": doc, "panelId": vcm.panel_id}
-        session.send_request(Request(REQ_GET_PANEL_COMPLETIONS, params), self._on_result_get_panel_completions)
+
+        def on_request_id(request_id: int) -> None:
+            # the re-sent request replaces the original one if the server's document is not the same version
+            if vcm.generation == generation:
+                vcm.request_id = request_id
+
+        plugin.send_doc_request_async(
+            self.view,
+            Request(REQ_GET_PANEL_COMPLETIONS, params),
+            self._on_result_get_panel_completions,
+            on_error=lambda _: plugin.stop_panel_completions(vcm, generation=generation),
+            on_request_id=on_request_id,
+        )
+
+        # the time budget starts when the request is sent, however long the server takes to respond
+        policy = get_session_setting(session, "panel_completion_early_stop") or {}
+        if timeout_ms := policy.get("timeout_ms", 0):
+            sublime.set_timeout_async(lambda: plugin.stop_panel_completions(vcm, generation=generation), timeout_ms)
 
     def _on_result_get_panel_completions(self, payload: CopilotPayloadPanelCompletionSolutionCount) -> None:
         count = payload["solutionCountTarget"]
         status_message(f"retrieving panel completions: {count}")
 
-        ViewPanelCompletionManager(self.view).open(completion_target_count=count)
+        vcm = ViewPanelCompletionManager(self.view)
+        vcm.open(completion_target_count=count)
 
 
 class CopilotPreviousCompletionCommand(CopilotTextCommand):
-    def run(self, _: sublime.Edit) -> None:
-        ViewCompletionManager(self.view).show_previous_completion()
+    @_provide_plugin_session()
+    def run(self, plugin: CopilotPlugin, session: Session, _: sublime.Edit) -> None:
+        plugin.show_adjacent_completion(self.view, -1)
 
 
 class CopilotNextCompletionCommand(CopilotTextCommand):
-    def run(self, _: sublime.Edit) -> None:
-        ViewCompletionManager(self.view).show_next_completion()
+    @_provide_plugin_session()
+    def run(self, plugin: CopilotPlugin, session: Session, _: sublime.Edit) -> None:
+        plugin.show_adjacent_completion(self.view, 1)
 
 
 class CopilotCheckStatusCommand(CopilotTextCommand):
@@ -871,6 +968,44 @@ class CopilotSignOutCommand(CopilotTextCommand):
         GithubInfo.clear_avatar()
 
 
+class CopilotShowMetricsCommand(CopilotWindowCommand):
+    requirement = REQUIRE_NOTHING
+
+    def run(self, reset: bool = False) -> None:
+        if reset:
+            Metrics.reset()
+            status_message("metrics have been reset.")
+            return
+
+        view = self.window.create_output_panel(f"{COPILOT_OUTPUT_PANEL_PREFIX}.metrics_view", unlisted=True)
+        view.assign_syntax("scope:source.json")
+
+        with mutable_view(view) as view:
+            view.run_command("select_all")
+            view.run_command("right_delete")
+            view.run_command("append", {"characters": json.dumps(Metrics.snapshot(), indent=4)})
+        self.window.run_command("show_panel", {"panel": f"output.{COPILOT_OUTPUT_PANEL_PREFIX}.metrics_view"})
+
+
+class CopilotShowConversationReferencesCommand(CopilotTextCommand):
+    requirement = REQUIRE_NOTHING
+
+    @_provide_plugin_session()
+    def run(self, plugin: CopilotPlugin, session: Session, _: sublime.Edit) -> None:
+        if not (window := self.view.window()):
+            return
+
+        panel_name = f"{COPILOT_OUTPUT_PANEL_PREFIX}.conversation_references_view"
+        view = window.create_output_panel(panel_name, unlisted=True)
+        view.assign_syntax("scope:source.json")
+
+        with mutable_view(view) as view:
+            view.run_command("select_all")
+            view.run_command("right_delete")
+            view.run_command("append", {"characters": json.dumps(plugin.reference_collector.last_decisions, indent=4)})
+        window.run_command("show_panel", {"panel": f"output.{panel_name}"})
+
+
 class CopilotConversationDebugCommand(CopilotTextCommand):
     @_provide_plugin_session()
     def run(self, plugin: CopilotPlugin, session: Session, _: sublime.Edit) -> None:
@@ -51,6 +51,15 @@ REQ_CONVERSATION_TEMPLATES = "conversation/templates"
 REQ_CONVERSATION_TURN = "conversation/turn"
 REQ_CONVERSATION_TURN_DELETE = "conversation/turnDelete"
 
+# ------------------- #
+# Copilot error codes #
+# ------------------- #
+
+# the server's copy of a document is not the version which a request refers to
+ERR_CONTENT_MODIFIED = -32801
+# a request is cancelled by the client
+ERR_REQUEST_CANCELLED = -32800
+
 # --------------------- #
 # Copilot notifications #
 # --------------------- #
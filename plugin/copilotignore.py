@@ -0,0 +1,154 @@
+"""
+Matching file paths against `.copilotignore` patterns.
+
+This module only depends on the standard library and `wcmatch` so that it can be benchmarked outside Sublime Text.
+See `scripts/benchmark_copilotignore.py`.
+"""
+
+from __future__ import annotations
+
+import itertools
+import re
+from collections import defaultdict
+from pathlib import PurePath
+from typing import Dict, Mapping, Optional, Pattern, Sequence, Tuple
+
+from wcmatch import glob
+
+_BucketKey = Tuple[Optional[str], Optional[int], Optional[str]]
+"""
+`(the literal first segment, the segment count, the literal extension of the last segment)`.
+`None` means a pattern isn't limited by that.
+"""
+_CompiledFolder = Tuple[PurePath, Dict[_BucketKey, Pattern[str]]]
+
+
+class CopilotIgnoreMatcher:
+    """
+    Decides whether a file path is ignored by the `.copilotignore` patterns of folders.
+
+    Each folder's patterns are compiled once, with the same semantics as
+    `glob.globmatch(relative_path, patterns, flags=glob.GLOBSTAR)`. Patterns are bucketed by their literal
+    first segment, by their segment count if they have no `**` and by the literal extension of their last
+    segment. Each bucket is a single regex, so a path is only tested against the few buckets which may match it.
+
+    Decisions are cached per file path. Changing patterns bumps `generation`, which invalidates all cached
+    decisions at once. Patterns are swapped together with the generation, so a lookup never mixes the
+    patterns of one generation with the decisions of another.
+    """
+
+    FLAGS = glob.GLOBSTAR
+
+    IGNORE_CASE = bool(re.match(glob.translate("A", flags=FLAGS)[0][0], "a"))
+    """Whether patterns are case-insensitive, which `wcmatch` decides by the platform."""
+
+    MAX_CACHED_DECISIONS = 100_000
+    """Cached decisions are dropped altogether once there are this many of them."""
+
+    _MAGIC_CHARS = frozenset("*?[\\")
+
+    def __init__(self, patterns: Mapping[str, Sequence[str]] | None = None) -> None:
+        self._patterns: dict[str, list[str]] = {}
+        self._state: tuple[int, list[_CompiledFolder]] = (0, [])
+        self._decisions: dict[str, tuple[int, bool]] = {}
+        if patterns:
+            self.set_patterns(patterns)
+
+    def __bool__(self) -> bool:
+        return bool(self._state[1])
+
+    @property
+    def generation(self) -> int:
+        """Bumped whenever patterns change."""
+        return self._state[0]
+
+    @property
+    def patterns(self) -> dict[str, list[str]]:
+        """The patterns per folder. Note that this is a copy."""
+        return {folder: list(patterns) for folder, patterns in self._patterns.items()}
+
+    def set_patterns(self, patterns: Mapping[str, Sequence[str]]) -> bool:
+        """Replaces patterns per folder. Returns whether they are changed, which is when they are recompiled."""
+        new_patterns = {folder: list(globs) for folder, globs in patterns.items() if globs}
+        if new_patterns == self._patterns:
+            return False
+
+        compiled = [(PurePath(folder), self._compile(globs)) for folder, globs in new_patterns.items()]
+        self._patterns = new_patterns
+        self._state = (self.generation + 1, compiled)
+        return True
+
+    def matches(self, file_path: str) -> bool:
+        """Whether `file_path` is ignored by the patterns of any folder containing it."""
+        generation, compiled = self._state
+        if (cached := self._decisions.get(file_path)) and cached[0] == generation:
+            return cached[1]
+
+        decision = self._match(file_path, compiled)
+        if len(self._decisions) >= self.MAX_CACHED_DECISIONS:
+            self._decisions = {}
+        self._decisions[file_path] = (generation, decision)
+        return decision
+
+    @classmethod
+    def _match(cls, file_path: str, compiled: list[_CompiledFolder]) -> bool:
+        path = PurePath(file_path)
+        for folder, buckets in compiled:
+            try:
+                relative_path = path.relative_to(folder).as_posix()
+            except ValueError:
+                continue
+            segments = [segment for segment in relative_path.split("/") if segment] or [""]
+            heads = (cls._normalize(segments[0]), None)
+            depths = (len(segments), None)
+            extensions = (cls._normalize(cls._extension(segments[-1])), None)
+            for key in itertools.product(heads, depths, extensions):
+                if (regex := buckets.get(key)) and regex.match(relative_path):
+                    return True
+        return False
+
+    @classmethod
+    def _compile(cls, patterns: Sequence[str]) -> dict[_BucketKey, Pattern[str]]:
+        bucketed: defaultdict[_BucketKey, list[str]] = defaultdict(list)
+        for pattern in patterns:
+            bucketed[cls._bucket_key(pattern)].append(pattern)
+
+        buckets: dict[_BucketKey, Pattern[str]] = {}
+        for key, bucket_patterns in bucketed.items():
+            # negation needs `glob.NEGATE`, so there are never exclude regexes
+            includes, _ = glob.translate(bucket_patterns, flags=cls.FLAGS)
+            if includes:
+                # every translated regex is anchored and scopes its own inline flags, so they can be alternated
+                buckets[key] = re.compile("|".join(includes))
+        return buckets
+
+    @classmethod
+    def _bucket_key(cls, pattern: str) -> _BucketKey:
+        # escaped characters make segments ambiguous, so such a pattern is never bucketed
+        if "\\" in pattern:
+            return (None, None, None)
+        if not (segments := [segment for segment in pattern.split("/") if segment]):
+            return (None, None, None)
+
+        head, last = segments[0], segments[-1]
+        # the dot may be inside a bracket, or a magic last segment may match any extension
+        extension = cls._extension(last)
+        is_any_extension = "[" in last or cls._is_magic(extension) or ("." not in last and cls._is_magic(last))
+        return (
+            None if cls._is_magic(head) or head in {".", ".."} else cls._normalize(head),
+            None if "**" in segments else len(segments),
+            None if is_any_extension else cls._normalize(extension),
+        )
+
+    @classmethod
+    def _is_magic(cls, text: str) -> bool:
+        return bool(cls._MAGIC_CHARS.intersection(text))
+
+    @staticmethod
+    def _extension(segment: str) -> str:
+        """The text after the last dot, or an empty string if there is no dot."""
+        return segment.rpartition(".")[2] if "." in segment else ""
+
+    @classmethod
+    def _normalize(cls, text: str) -> str:
+        return text.lower() if cls.IGNORE_CASE else text
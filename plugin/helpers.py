@@ -1,30 +1,45 @@
 from __future__ import annotations
 
+import copy
+import hashlib
 import itertools
+import json
 import os
 import re
+import statistics
 import threading
 import time
+from collections import OrderedDict, deque
 from operator import itemgetter
 from pathlib import Path
-from typing import Any, Callable, Literal, Sequence, cast
+from typing import Any, Callable, Hashable, Iterable, Literal, Sequence, cast
 
+import mdpopups
 import requests
 import sublime
 from LSP.plugin.core.protocol import Position as LspPosition
 from LSP.plugin.core.protocol import Range as LspRange
 from LSP.plugin.core.url import filename_to_uri
 from more_itertools import duplicates_everseen, first_true
-from wcmatch import glob
 
-from .constants import COPILOT_WINDOW_SETTINGS_PREFIX, PACKAGE_NAME
+from .constants import (
+    COPILOT_WINDOW_SETTINGS_PREFIX,
+    PACKAGE_NAME,
+    REQ_NOTIFY_ACCEPTED,
+    REQ_NOTIFY_REJECTED,
+    REQ_NOTIFY_SHOWN,
+)
+from .copilotignore import CopilotIgnoreMatcher
 from .log import log_error
+from .metrics import Metrics
 from .settings import get_plugin_setting_dotted
 from .types import (
+    CopilotConversationReferenceDecision,
     CopilotConversationTemplates,
     CopilotDocType,
     CopilotGitHubWebSearch,
     CopilotPayloadCompletion,
+    CopilotPayloadConversationEntry,
     CopilotPayloadPanelSolution,
     CopilotRequestConversationTurn,
     CopilotRequestConversationTurnReference,
@@ -33,10 +48,10 @@ from .types import (
 from .utils import (
     all_views,
     all_windows,
+    clamp,
     drop_falsy,
     erase_copilot_setting,
     erase_copilot_view_setting,
-    get_copilot_setting,
     get_project_relative_path,
     get_view_language_id,
     set_copilot_setting,
@@ -71,6 +86,420 @@ class ActivityIndicator:
             time.sleep(0.1)
 
 
+class AdaptiveDelay:
+    """
+    Decides the debounce delay of completion requests from the typing cadence and the server latency.
+
+    The delay is `pause_factor * typing_interval + latency_factor * p50_latency`, clamped to
+    `[min_delay_s, max_delay_s]`. The typing interval is an exponential moving average of inter-keystroke
+    intervals and the latency is the median of the recent completion requests. All methods are thread-safe.
+    """
+
+    def __init__(
+        self,
+        *,
+        default_delay_s: float = 0.3,
+        min_delay_s: float = 0.1,
+        max_delay_s: float = 0.6,
+        pause_factor: float = 1.5,
+        latency_factor: float = 0.25,
+        latency_samples: int = 20,
+    ) -> None:
+        self.default_delay_s = default_delay_s
+        self.min_delay_s = min_delay_s
+        self.max_delay_s = max_delay_s
+        self.pause_factor = pause_factor
+        self.latency_factor = latency_factor
+
+        self._lock = threading.Lock()
+        self._last_keystroke_time = 0.0
+        self._typing_interval_s: float | None = None
+        self._latencies_s: deque[float] = deque(maxlen=latency_samples)
+
+    def record_keystroke(self, *, now: float | None = None) -> None:
+        now = time.perf_counter() if now is None else now
+        with self._lock:
+            interval = now - self._last_keystroke_time
+            self._last_keystroke_time = now
+            # a long interval is a pause rather than the typing cadence
+            if interval > self.max_delay_s * 2:
+                return
+            if self._typing_interval_s is None:
+                self._typing_interval_s = interval
+            else:
+                self._typing_interval_s = 0.8 * self._typing_interval_s + 0.2 * interval
+
+    def record_latency(self, latency_s: float) -> None:
+        with self._lock:
+            self._latencies_s.append(latency_s)
+
+    def delay(self) -> float:
+        """The delay in seconds."""
+        with self._lock:
+            if self._typing_interval_s is None:
+                return self.default_delay_s
+            latency_s = statistics.median(self._latencies_s) if self._latencies_s else 0.0
+            delay_s = self.pause_factor * self._typing_interval_s + self.latency_factor * latency_s
+        return clamp(delay_s, self.min_delay_s, self.max_delay_s)
+
+
+class CompletionCache:
+    """
+    A LRU cache of preprocessed completions.
+
+    The key is made of the buffer ID, the caret region and a digest of the text around the caret,
+    so the cached completions are reused when the same text around the same caret shows up again.
+    All methods are thread-safe.
+    """
+
+    CHARS_BEFORE = 2000
+    """The count of characters before the caret which are used to make the key."""
+    CHARS_AFTER = 500
+    """The count of characters after the caret which are used to make the key."""
+
+    def __init__(self, *, max_size: int = 128, max_age_s: float = 300) -> None:
+        self.max_size = max_size
+        self.max_age_s = max_age_s
+
+        self._lock = threading.Lock()
+        self._items: OrderedDict[Hashable, tuple[float, list[CopilotPayloadCompletion], bool]] = OrderedDict()
+
+    @classmethod
+    def make_key(cls, view: sublime.View, region: sublime.Region) -> Hashable:
+        return cls.make_text_key(
+            view.buffer_id(),
+            region,
+            view.substr(sublime.Region(max(0, region.begin() - cls.CHARS_BEFORE), region.begin())),
+            view.substr(region),
+            view.substr(sublime.Region(region.end(), min(view.size(), region.end() + cls.CHARS_AFTER))),
+        )
+
+    @classmethod
+    def make_text_key(cls, buffer_id: int, region: sublime.Region, before: str, selected: str, after: str) -> Hashable:
+        """Make the key from the text `before`/`after` the caret `region`, which may be not in the view yet."""
+        text = before[-cls.CHARS_BEFORE :] + "\0" + selected + "\0" + after[: cls.CHARS_AFTER]
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        return (buffer_id, region.to_tuple(), digest)
+
+    def get(self, key: Hashable) -> tuple[list[CopilotPayloadCompletion], bool] | None:
+        """
+        Get a copy of the cached completions and whether they include the cycling alternatives,
+        or `None` if there is no fresh one.
+        """
+        with self._lock:
+            if not (item := self._items.get(key)):
+                return None
+            created_time, completions, has_fetched_cycling = item
+            if time.monotonic() - created_time > self.max_age_s:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return copy.deepcopy(completions), has_fetched_cycling
+
+    def put(
+        self,
+        key: Hashable,
+        completions: list[CopilotPayloadCompletion],
+        *,
+        has_fetched_cycling: bool = False,
+    ) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic(), copy.deepcopy(completions), has_fetched_cycling)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+class HighlightCache:
+    """
+    A bounded LRU cache of syntax-highlighted code HTML, shared by the popup, the panel and the chat panel.
+
+    The key is made of the color scheme, the language ID and a digest of the code, so a snippet is only
+    highlighted once no matter where it's shown again. Memory is bounded by the total length of cached HTML.
+    All methods are thread-safe.
+    """
+
+    MAX_CHARS = 2_000_000
+    """The maximum total length of cached HTML."""
+
+    FENCED_CODE_BLOCK_PATTERN = re.compile(
+        r"^(?P<fence>`{3,}|~{3,})[ \t]*(?P<lang>[^\s`]*)[^\n]*\n(?P<code>.*?)\n(?P=fence)[ \t]*$",
+        re.MULTILINE | re.DOTALL,
+    )
+
+    _lock = threading.Lock()
+    _items: OrderedDict[Hashable, str] = OrderedDict()
+    _chars = 0
+
+    @classmethod
+    def highlight(cls, view: sublime.View, code: str, lang: str) -> str:
+        """Returns the HTML of `code` highlighted as `lang` with the color scheme of `view`."""
+        digest = hashlib.blake2b(code.encode("utf-8"), digest_size=16).digest()
+        key = (view.settings().get("color_scheme"), lang, digest)
+        with cls._lock:
+            if (html := cls._items.get(key)) is not None:
+                cls._items.move_to_end(key)
+                Metrics.increase("highlight_cache.hits")
+                return html
+        Metrics.increase("highlight_cache.misses")
+
+        html = mdpopups.syntax_highlight(view, code, language=lang or None)
+        with cls._lock:
+            if key not in cls._items:
+                cls._items[key] = html
+                cls._chars += len(html)
+            while cls._chars > cls.MAX_CHARS and cls._items:
+                cls._chars -= len(cls._items.popitem(last=False)[1])
+        return html
+
+    @classmethod
+    def highlight_markdown(cls, view: sublime.View, markdown: str, *, is_streaming: bool = False) -> str:
+        """
+        Replaces closed fenced code blocks which start at the beginning of a line with their highlighted HTML.
+        Other code blocks, such as the indented ones in a list, are left for the markdown converter.
+
+        If `is_streaming`, the code block at the very end of `markdown` may be still growing, so it's highlighted
+        without being cached. Otherwise, every partial snapshot of it would be cached.
+        """
+
+        def replace(match: re.Match[str]) -> str:
+            code, lang = match.group("code"), match.group("lang")
+            if is_streaming and not markdown[match.end() :].strip():
+                html = mdpopups.syntax_highlight(view, code, language=lang or None)
+            else:
+                html = cls.highlight(view, code, lang)
+            return f"\n{html}\n"
+
+        return cls.FENCED_CODE_BLOCK_PATTERN.sub(replace, markdown)
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._items.clear()
+            cls._chars = 0
+
+
+class TelemetryQueue:
+    """
+    Batches completion telemetry so that it doesn't compete with completion requests.
+
+    Rejected UUIDs are merged into a single "notifyRejected" request and duplicated events are dropped.
+    An accepted UUID is never reported as rejected in the same batch.
+    The queue is flushed `flush_interval_s` seconds after the first queued event, or immediately when
+    there are `max_size` events. All methods are thread-safe.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str, dict[str, Any]], None],
+        *,
+        max_size: int = 32,
+        flush_interval_s: float = 5,
+    ) -> None:
+        self.send = send
+        self.max_size = max_size
+        self.flush_interval_s = flush_interval_s
+
+        self._lock = threading.Lock()
+        self._shown: dict[str, None] = {}
+        self._accepted: dict[str, None] = {}
+        self._rejected: dict[str, None] = {}
+        self._is_flush_scheduled = False
+
+    def shown(self, uuid: str) -> None:
+        self._add(self._shown, (uuid,))
+
+    def accepted(self, uuid: str) -> None:
+        self._add(self._accepted, (uuid,))
+
+    def rejected(self, uuids: Iterable[str]) -> None:
+        self._add(self._rejected, uuids)
+
+    def flush(self) -> None:
+        with self._lock:
+            shown, self._shown = self._shown, {}
+            accepted, self._accepted = self._accepted, {}
+            rejected, self._rejected = self._rejected, {}
+            self._is_flush_scheduled = False
+
+        for uuid in shown:
+            self.send(REQ_NOTIFY_SHOWN, {"uuid": uuid})
+        for uuid in accepted:
+            self.send(REQ_NOTIFY_ACCEPTED, {"uuid": uuid})
+        if uuids := [uuid for uuid in rejected if uuid not in accepted]:
+            self.send(REQ_NOTIFY_REJECTED, {"uuids": uuids})
+
+    def _add(self, events: dict[str, None], uuids: Iterable[str]) -> None:
+        with self._lock:
+            events.update(dict.fromkeys(uuids))
+            is_full = len(self._shown) + len(self._accepted) + len(self._rejected) >= self.max_size
+            should_schedule = not (is_full or self._is_flush_scheduled)
+            if should_schedule:
+                self._is_flush_scheduled = True
+
+        if is_full:
+            sublime.set_timeout_async(self.flush)
+        elif should_schedule:
+            sublime.set_timeout_async(self.flush, int(self.flush_interval_s * 1000))
+
+
+class FrameRateLimiter:
+    """
+    Merges render requests so that `render` runs at most once per frame interval.
+
+    A request arriving while a render is pending is dropped because the pending render will cover it.
+    `render` is called in the caller's thread if it may run immediately, or in ST's async thread otherwise.
+    Counters are recorded as `<name>.renders` and `<name>.dropped_frames` in `Metrics`.
+    """
+
+    def __init__(self, render: Callable[[], None], max_fps: Callable[[], float], *, name: str) -> None:
+        self.render = render
+        self.max_fps = max_fps
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._is_scheduled = False
+        self._last_render_s = 0.0
+
+    def request(self, *, immediately: bool = False) -> None:
+        """Requests a render. With `immediately`, any pending render is cancelled and replaced by this one."""
+        with self._lock:
+            now = time.monotonic()
+            wait_s = self._last_render_s + 1 / max(self.max_fps(), 1) - now
+            if immediately or (wait_s <= 0 and not self._is_scheduled):
+                self._generation += 1
+                self._is_scheduled = False
+                self._last_render_s = now
+                should_render = True
+            elif self._is_scheduled:
+                Metrics.increase(f"{self.name}.dropped_frames")
+                return
+            else:
+                self._is_scheduled = True
+                should_render = False
+                generation = self._generation
+
+        if should_render:
+            self._render()
+        else:
+            sublime.set_timeout_async(lambda: self._on_timer(generation), int(wait_s * 1000))
+
+    def _on_timer(self, generation: int) -> None:
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._is_scheduled = False
+            self._last_render_s = time.monotonic()
+        self._render()
+
+    def _render(self) -> None:
+        Metrics.increase(f"{self.name}.renders")
+        self.render()
+
+
+class ReferenceCollector:
+    """
+    Collects references of a conversation turn from the selections of views.
+
+    The reference of a view is cached until the view's `change_count`, selection or visible region changes.
+    Views are ranked by the time they were last activated, with the active view first. References are added
+    until `max_count` references or `max_chars` selected characters are reached. The decisions of the last
+    collection are kept in `last_decisions` for debugging.
+    """
+
+    def __init__(self) -> None:
+        self.last_decisions: list[CopilotConversationReferenceDecision] = []
+        self._activation_counter = itertools.count(1)
+        self._view_activations: dict[int, int] = {}
+        """key = view ID; value = activation order"""
+        self._view_references: dict[int, tuple[Hashable, CopilotRequestConversationTurnReference | None, int]] = {}
+        """key = view ID; value = (cache key, reference, selected characters)"""
+
+    def record_activation(self, view: sublime.View) -> None:
+        self._view_activations[view.id()] = next(self._activation_counter)
+
+    def collect(
+        self,
+        active_view: sublime.View,
+        views: Iterable[sublime.View],
+        *,
+        max_count: int = 20,
+        max_chars: int = 100_000,
+    ) -> list[CopilotRequestConversationTurnReference]:
+        views_ = sorted(
+            (view for view in views if view.id() != active_view.id()),
+            key=lambda view: self._view_activations.get(view.id(), 0),
+            reverse=True,
+        )
+        views_.insert(0, active_view)
+
+        references: list[CopilotRequestConversationTurnReference] = []
+        decisions: list[CopilotConversationReferenceDecision] = []
+        total_chars = 0
+        for view in views_:
+            reference, chars, is_cached = self._view_reference(view)
+            uri = reference["uri"] if reference else self._view_uri(view)
+            status: Literal["included", "skipped"]
+            if not reference:
+                status, reason = "skipped", "empty selection"
+            elif len(references) >= max_count:
+                status, reason = "skipped", f"over count budget ({max_count})"
+            elif total_chars + chars > max_chars:
+                status, reason = "skipped", f"over size budget ({max_chars} chars)"
+            else:
+                status, reason = "included", "active view" if view == active_view else "recently activated view"
+                references.append(reference.copy())
+                total_chars += chars
+            decisions.append({"uri": uri, "status": status, "reason": reason, "chars": chars, "isCached": is_cached})
+
+        # forget closed views
+        view_ids = {view.id() for view in views_}
+        self._view_references = {id: value for id, value in self._view_references.items() if id in view_ids}
+        self._view_activations = {id: value for id, value in self._view_activations.items() if id in view_ids}
+
+        self.last_decisions = decisions
+        Metrics.increase("conversation_references.included", len(references))
+        Metrics.increase("conversation_references.skipped", len(decisions) - len(references))
+        return references
+
+    def _view_reference(self, view: sublime.View) -> tuple[CopilotRequestConversationTurnReference | None, int, bool]:
+        """Returns `(reference, selected characters, is cached)` of the view."""
+        if not (sel := view.sel()):
+            return None, 0, False
+
+        selection = sel[0]
+        visible_region = view.visible_region()
+        cache_key = (view.change_count(), selection.to_tuple(), visible_region.to_tuple())
+        if (cached := self._view_references.get(view.id())) and cached[0] == cache_key:
+            return cached[1], cached[2], True
+
+        reference: CopilotRequestConversationTurnReference | None = None
+        if selection and not view.substr(selection).isspace():
+            reference = {
+                "type": "file",
+                "status": "included",  # included, blocked, notfound, empty
+                "uri": self._view_uri(view),
+                "position": st_point_to_lsp_position(selection.begin(), view),
+                "range": st_region_to_lsp_range(selection, view),
+                "visibleRange": st_region_to_lsp_range(visible_region, view),
+                "selection": st_region_to_lsp_range(selection, view),
+                "openedAt": None,
+                "activeAt": None,
+            }
+        chars = selection.size() if reference else 0
+        self._view_references[view.id()] = (cache_key, reference, chars)
+        return reference, chars, False
+
+    @staticmethod
+    def _view_uri(view: sublime.View) -> str:
+        return filename_to_uri(file_path) if (file_path := view.file_name()) else f"buffer:{view.buffer().id()}"
+
+
 class GithubInfo:
     AVATAR_PATH = Path(sublime.cache_path()) / f"{PACKAGE_NAME}/avatar.png"
     AVATAR_RESOURCE_URL = f"res://Cache/{PACKAGE_NAME}/avatar.png"
@@ -113,14 +542,97 @@ class GithubInfo:
         cls.AVATAR_PATH.unlink(missing_ok=True)
 
 
+class ConversationTranscript:
+    """
+    An append-only JSONL file of conversation entries in the cache directory.
+
+    Conversations are kept out of window settings because those are written into the session file.
+    """
+
+    DIRECTORY = Path(sublime.cache_path()) / f"{PACKAGE_NAME}/conversations"
+
+    def __init__(self, name: str) -> None:
+        self.path = self.DIRECTORY / f"{name}.jsonl"
+
+    def load(self) -> list[CopilotPayloadConversationEntry]:
+        try:
+            lines = self.path.read_text(encoding="utf-8").splitlines()
+        except FileNotFoundError:
+            return []
+        except OSError as e:
+            log_error(f"Failed to load conversation transcript {self.path}: {e}")
+            return []
+
+        entries: list[CopilotPayloadConversationEntry] = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # e.g., the last line is partially written because ST was killed
+                log_error(f"Skipped a malformed line in conversation transcript {self.path}.")
+        return entries
+
+    def append(self, entries: Iterable[CopilotPayloadConversationEntry]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a", encoding="utf-8") as f:
+            f.writelines(f"{json.dumps(entry, ensure_ascii=False)}\n" for entry in entries)
+
+    def rewrite(self, entries: Iterable[CopilotPayloadConversationEntry]) -> None:
+        """Replaces the whole transcript, e.g., after turns are deleted."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            f.writelines(f"{json.dumps(entry, ensure_ascii=False)}\n" for entry in entries)
+        os.replace(tmp_path, self.path)
+
+    def delete(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+    @classmethod
+    def expire(cls, max_age_s: float, *, keep: Iterable[str] = ()) -> int:
+        """
+        Deletes transcripts which haven't been written for `max_age_s` seconds, except those named in `keep`.
+        Returns the count of deleted transcripts.
+        """
+        keep = set(keep)
+        deadline = time.time() - max_age_s
+        count = 0
+        try:
+            for path in cls.DIRECTORY.glob("*.jsonl"):
+                if path.stem not in keep and path.stat().st_mtime < deadline:
+                    path.unlink(missing_ok=True)
+                    count += 1
+        except OSError as e:
+            log_error(f"Failed to delete conversation transcripts in {cls.DIRECTORY}: {e}")
+        return count
+
+
 class CopilotIgnore:
+    """
+    The `.copilotignore` patterns of a window.
+
+    Patterns are read from the window's folders only by `load_patterns()`, which is called when the plugin
+    is loaded, when a `.copilotignore` file is changed, or lazily when the window's folders are changed.
+    Checking a view never touches the file system.
+    """
+
+    _window_to_matcher: dict[int, CopilotIgnoreMatcher] = {}
+    """key = window ID. The compiled patterns of the window."""
+    _window_to_folders: dict[int, tuple[str, ...]] = {}
+    """key = window ID. The folders which the patterns of the window are loaded from."""
+
     def __init__(self, window: sublime.Window) -> None:
         self.window = window
         self.patterns: dict[str, list[str]] = {}
-        self.load_patterns()
+
+    @property
+    def matcher(self) -> CopilotIgnoreMatcher:
+        return self._window_to_matcher.setdefault(self.window.id(), CopilotIgnoreMatcher())
 
     @classmethod
     def cleanup(cls) -> None:
+        cls._window_to_matcher.clear()
+        cls._window_to_folders.clear()
         for window in all_windows():
             erase_copilot_setting(window, COPILOT_WINDOW_SETTINGS_PREFIX, "copilotignore.patterns")
         for view in all_views():
@@ -128,15 +640,21 @@ class CopilotIgnore:
 
     def unload_patterns(self) -> None:
         self.patterns.clear()
+        self._window_to_matcher.pop(self.window.id(), None)
+        self._window_to_folders.pop(self.window.id(), None)
         erase_copilot_setting(self.window, COPILOT_WINDOW_SETTINGS_PREFIX, "copilotignore.patterns")
 
     def load_patterns(self) -> None:
         self.patterns.clear()
 
         # Load workspace patterns
-        for folder in self.window.folders():
+        folders = self.window.folders()
+        for folder in folders:
             self.add_patterns_from_file(os.path.join(folder, ".copilotignore"), folder)
 
+        # only recompiled (and cached decisions invalidated) if patterns are changed
+        self.matcher.set_patterns(self.patterns)
+        self._window_to_folders[self.window.id()] = tuple(folders)
         set_copilot_setting(self.window, COPILOT_WINDOW_SETTINGS_PREFIX, "copilotignore.patterns", self.patterns)
 
     def read_ignore_patterns(self, file_path: str) -> list[str]:
@@ -150,24 +668,15 @@ class CopilotIgnore:
             self.patterns[folder] = patterns
 
     def matches_any_pattern(self, file_path: str | Path) -> bool:
-        file_path = Path(file_path)
-        loaded_patterns: dict[str, list[str]] = get_copilot_setting(
-            self.window,
-            COPILOT_WINDOW_SETTINGS_PREFIX,
-            "copilotignore.patterns",
-            self.patterns,
-        )
-        for folder, patterns in loaded_patterns.items():
-            try:
-                relative_path = file_path.relative_to(folder).as_posix()
-            except ValueError:
-                continue
-            if glob.globmatch(relative_path, patterns, flags=glob.GLOBSTAR):
-                return True
-        return False
+        return self.matcher.matches(str(file_path))
+
+    def reload_patterns_if_folders_changed(self) -> None:
+        if self._window_to_folders.get(self.window.id()) != tuple(self.window.folders()):
+            self.load_patterns()
 
     def trigger(self, view: sublime.View) -> bool:
-        if self.patterns and (file := view.file_name()):
+        self.reload_patterns_if_folders_changed()
+        if self.matcher and (file := view.file_name()):
             return self.matches_any_pattern(file)
         return False
 
@@ -195,11 +704,140 @@ def lsp_range_to_st_region(range_: LspRange, view: sublime.View) -> sublime.Regi
     )
 
 
-def prepare_completion_request_doc(view: sublime.View) -> CopilotDocType | None:
-    selection = view.sel()[0]
+def get_context_window_region(
+    view: sublime.View,
+    point: int,
+    *,
+    lines_before: int = 0,
+    lines_after: int = 0,
+    chars_before: int = 0,
+    chars_after: int = 0,
+) -> sublime.Region:
+    """
+    Get the region around `point` which should be sent to the server as the document. A non-positive limit
+    means no limit. The region always consists of whole lines and the line of `point` is always included.
+    """
+    line = view.line(point)
+    begin, end = 0, view.size()
+
+    if lines_before > 0:
+        row = view.rowcol(point)[0]
+        begin = max(begin, view.text_point(max(0, row - lines_before), 0))
+    if chars_before > 0 and point - begin > chars_before:
+        # the first whole line which is in the limit
+        begin = min(view.full_line(point - chars_before).end(), line.begin())
+
+    if lines_after > 0:
+        row = view.rowcol(point)[0]
+        last_row = view.rowcol(end)[0]
+        end = min(end, view.line(view.text_point(min(last_row, row + lines_after), 0)).end())
+    if chars_after > 0 and end - point > chars_after:
+        # the end of the last whole line which is in the limit
+        end = max(view.line(point + chars_after).begin(), line.end())
+
+    return sublime.Region(begin, end)
+
+
+UNSYNCED_DOC_VERSION = -1
+"""
+The `version` of a `doc` whose `source` isn't the whole text of any version of the document, e.g., a truncated one.
+No version which is synced to the server is negative, so the server never mistakes such a `source` for the document.
+"""
+
+
+def prepare_completion_request_doc(
+    view: sublime.View,
+    *,
+    synced_version: int | None = None,
+    context_region: sublime.Region | None = None,
+) -> CopilotDocType | None:
+    """
+    Prepare the `doc` param for document-related requests.
+
+    If `context_region` is given and is only a part of the document, only that part is sent with
+    `UNSYNCED_DOC_VERSION` and the `position` is relative to it. See `get_context_window_region()`.
+    This takes precedence over `synced_version`, so the `source` is never omitted in this case.
+
+    Otherwise, if `synced_version` (the version of the document which has been synced to the server) is
+    the same as the view's current version, the `source` is omitted and the server will use its own copy.
+    """
+    doc = _prepare_request_doc_without_source(view, view.sel()[0].begin())
+    if context_region and context_region.size() < view.size():
+        # the context region always starts at the beginning of a line so the column is unchanged
+        doc["position"]["line"] -= view.rowcol(context_region.begin())[0]
+        doc["source"] = view.substr(context_region)
+        doc["version"] = UNSYNCED_DOC_VERSION
+        Metrics.increase("context_window.chars_trimmed", view.size() - context_region.size())
+        Metrics.increase("doc_sync.requests_with_source")
+    elif synced_version == doc["version"]:
+        # `view.size()` is the count of characters, which is the same as bytes for ASCII-only documents
+        Metrics.increase("doc_sync.bytes_saved", view.size())
+        Metrics.increase("doc_sync.requests_without_source")
+    else:
+        doc["source"] = view.substr(sublime.Region(0, view.size()))
+        Metrics.increase("doc_sync.requests_with_source")
+    return doc
+
+
+def prepare_next_line_request_doc(
+    view: sublime.View,
+    point: int,
+    *,
+    context_region: sublime.Region | None = None,
+) -> tuple[CopilotDocType, str]:
+    """
+    Prepare the `doc` param as if a newline had been typed at `point`, which is usually the end of a line.
+    The new line is indented as Sublime Text would do (see `get_new_line_indentation()`) and the `position`
+    is at the end of the indentation. Since the `source` never existed in the view, it's sent with
+    `UNSYNCED_DOC_VERSION`.
+
+    Returns the `doc` and the indentation of the new line.
+    """
+    context_region = context_region or sublime.Region(0, view.size())
+    indentation = get_new_line_indentation(view, point)
+
+    doc = _prepare_request_doc_without_source(view, point)
+    doc["position"] = {
+        "line": view.rowcol(point)[0] - view.rowcol(context_region.begin())[0] + 1,
+        "character": len(indentation),
+    }
+    doc["source"] = (
+        view.substr(sublime.Region(context_region.begin(), point))
+        + "\n"
+        + indentation
+        + view.substr(sublime.Region(point, context_region.end()))
+    )
+    doc["version"] = UNSYNCED_DOC_VERSION
+    return doc, indentation
+
+
+def get_new_line_indentation(view: sublime.View, point: int) -> str:
+    """
+    Predict the indentation of the new line if a newline was typed at `point`. Like Sublime Text's "auto_indent",
+    it's the indentation of the line of `point`, plus one level if the text before `point` matches the
+    syntax's "increaseIndentPattern".
+    """
+    if not view.settings().get("auto_indent"):
+        return ""
+
+    line_before = view.substr(sublime.Region(view.line(point).begin(), point))
+    indentation = re.match(r"[ \t]*", line_before).group()  # type: ignore
+    if (pattern := view.meta_info("increaseIndentPattern", point)) and isinstance(pattern, str):
+        try:
+            # the pattern is written for Oniguruma, so it may be incompatible with Python's `re`
+            should_increase = bool(re.search(pattern, line_before))
+        except re.error:
+            should_increase = False
+        if should_increase:
+            settings = view.settings()
+            tab_size = cast(int, settings.get("tab_size"))
+            indentation += " " * tab_size if settings.get("translate_tabs_to_spaces") else "\t"
+    return indentation
+
+
+def _prepare_request_doc_without_source(view: sublime.View, point: int) -> CopilotDocType:
     file_path = view.file_name() or f"buffer:{view.buffer().id()}"
     return {
-        "source": view.substr(sublime.Region(0, view.size())),
         "tabSize": cast(int, view.settings().get("tab_size")),
         "indentSize": 1,  # there is no such concept in ST
         "insertSpaces": cast(bool, view.settings().get("translate_tabs_to_spaces")),
@@ -207,7 +845,7 @@ def prepare_completion_request_doc(view: sublime.View) -> CopilotDocType | None:
         "uri": file_path if file_path.startswith("buffer:") else filename_to_uri(file_path),
         "relativePath": get_project_relative_path(file_path),
         "languageId": get_view_language_id(view),
-        "position": st_point_to_lsp_position(selection.begin(), view),
+        "position": st_point_to_lsp_position(point, view),
         # Buffer Version. Generally this is handled by LSP, but we need to handle it here
         # Will need to test getting the version from LSP
         "version": view.change_count(),
@@ -216,40 +854,21 @@ def prepare_completion_request_doc(view: sublime.View) -> CopilotDocType | None:
 
 def prepare_conversation_turn_request(
     conversation_id: str,
-    window_id: int,
+    work_done_token: str,
     message: str,
     view: sublime.View,
-    views: list[sublime.View],
+    references: list[CopilotRequestConversationTurnReference | CopilotGitHubWebSearch],
     source: Literal["panel", "inline"] = "panel",
+    *,
+    synced_version: int | None = None,
 ) -> CopilotRequestConversationTurn | None:
-    if not (doc := prepare_completion_request_doc(view)):
+    if not (doc := prepare_completion_request_doc(view, synced_version=synced_version)):
         return None
 
-    # References can technicaly be across multiple files
-    # TODO: Support references across multiple files
-    references: list[CopilotRequestConversationTurnReference | CopilotGitHubWebSearch] = []
-    visible_range = st_region_to_lsp_range(view.visible_region(), view)
-    views.append(view)
-    for view_ in views:
-        if not (selection := view_.sel()[0]) or view_.substr(selection).isspace():
-            continue
-
-        references.append({
-            "type": "file",
-            "status": "included",  # included, blocked, notfound, empty
-            "uri": filename_to_uri(file_path) if (file_path := view_.file_name()) else f"buffer:{view.buffer().id()}",
-            "position": st_point_to_lsp_position(selection.begin(), view_),
-            "range": st_region_to_lsp_range(selection, view),
-            "visibleRange": visible_range,
-            "selection": st_region_to_lsp_range(selection, view_),
-            "openedAt": None,
-            "activeAt": None,
-        })
-
     return {
         "conversationId": conversation_id,
         "message": message,
-        "workDoneToken": f"copilot_chat://{window_id}",
+        "workDoneToken": work_done_token,
         "doc": doc,
         "computeSuggestions": True,
         "references": references,
@@ -307,8 +926,23 @@ def preprocess_chat_message(
     return is_template, message
 
 
-def preprocess_completions(view: sublime.View, completions: list[CopilotPayloadCompletion]) -> None:
-    """Preprocess the `completions` from "getCompletions" request."""
+def shift_lsp_range_lines(range_: LspRange, line_offset: int) -> None:
+    """Shift the `range_` by `line_offset` lines in-place."""
+    range_["start"]["line"] += line_offset
+    range_["end"]["line"] += line_offset
+
+
+def preprocess_completions(
+    view: sublime.View,
+    completions: list[CopilotPayloadCompletion],
+    *,
+    line_offset: int = 0,
+) -> None:
+    """
+    Preprocess the `completions` from "getCompletions" request.
+
+    The `line_offset` is the row of the first line sent to the server, if only a part of the document was sent.
+    """
     # in-place de-duplication
     duplicate_indexes = list(
         map(
@@ -322,13 +956,23 @@ def preprocess_completions(view: sublime.View, completions: list[CopilotPayloadC
 
     # inject extra information for convenience
     for completion in completions:
+        if line_offset:
+            completion["position"]["line"] += line_offset
+            shift_lsp_range_lines(completion["range"], line_offset)
         completion["point"] = lsp_position_to_st_point(completion["position"], view)
         completion["region"] = lsp_range_to_st_region(completion["range"], view).to_tuple()
 
 
-def preprocess_panel_completions(view: sublime.View, completions: Sequence[CopilotPayloadPanelSolution]) -> None:
+def preprocess_panel_completions(
+    view: sublime.View,
+    completions: Sequence[CopilotPayloadPanelSolution],
+    *,
+    line_offset: int = 0,
+) -> None:
     """Preprocess the `completions` from "getCompletionsCycling" request."""
     for completion in completions:
+        if line_offset:
+            shift_lsp_range_lines(completion["range"], line_offset)
         completion["region"] = lsp_range_to_st_region(completion["range"], view).to_tuple()
 
 
@@ -13,8 +13,18 @@ from watchdog.observers.api import ObservedWatch
 from .client import CopilotPlugin
 from .decorators import must_be_active_view
 from .helpers import CopilotIgnore
-from .ui import ViewCompletionManager, ViewPanelCompletionManager, WindowConversationManager
-from .utils import all_windows, get_copilot_view_setting, get_session_setting, set_copilot_view_setting
+from .metrics import Metrics
+from .ui import ViewCompletionManager, ViewPanelCompletionManager, WindowChatPanel
+from .utils import (
+    all_windows,
+    get_copilot_view_setting,
+    get_session_setting,
+    register_view,
+    register_window,
+    set_copilot_view_setting,
+    unregister_view,
+    unregister_window,
+)
 
 
 class ViewEventListener(sublime_plugin.ViewEventListener):
@@ -52,14 +62,26 @@ class ViewEventListener(sublime_plugin.ViewEventListener):
         if not plugin or not session:
             return
 
+        plugin.completion_delay.record_keystroke()
+        plugin.cancel_completion_requests_async(self.view)
+
         vcm = ViewCompletionManager(self.view)
+        # the user is typing what the visible completion suggests so there is no need for new completions
+        if vcm.handle_type_ahead():
+            Metrics.increase("completions.typed_ahead")
+            return
+
         vcm.handle_text_change()
 
         if not self._is_saving and get_session_setting(session, "auto_ask_completions") and not vcm.is_waiting:
+            # cached (or prefetched) completions are shown immediately without debouncing,
+            # and a miss is recorded by the debounced lookup
+            if plugin.show_cached_completions(self.view, record_miss=False):
+                return
             plugin.request_get_completions(self.view)
 
     def on_activated_async(self) -> None:
-        _, session = CopilotPlugin.plugin_session(self.view)
+        plugin, session = CopilotPlugin.plugin_session(self.view)
 
         #        if (session and CopilotPlugin.should_ignore(self.view)) or (
         #            not session and not CopilotPlugin.should_ignore(self.view)
@@ -69,9 +91,10 @@ class ViewEventListener(sublime_plugin.ViewEventListener):
         #           self.view.settings().set("lsp_uri", "")
         #           sublime.set_timeout_async(lambda: self.view.settings().set("lsp_uri", prev_setting), 5)
 
-        if session and not CopilotPlugin.should_ignore(self.view):
+        if plugin and session and not CopilotPlugin.should_ignore(self.view):
+            plugin.reference_collector.record_activation(self.view)
             if (window := self.view.window()) and self.view.name() != "Copilot Chat":
-                WindowConversationManager(window).last_active_view_id = self.view.id()
+                WindowChatPanel(window).last_active_view_id = self.view.id()
 
     def on_deactivated_async(self) -> None:
         ViewCompletionManager(self.view).hide()
@@ -82,6 +105,7 @@ class ViewEventListener(sublime_plugin.ViewEventListener):
 
     def on_close(self) -> None:
         ViewCompletionManager(self.view).handle_close()
+        ViewPanelCompletionManager(self.view).handle_close()
 
     def on_query_context(self, key: str, operator: int, operand: Any, match_all: bool) -> bool | None:
         def test(value: Any) -> bool | None:
@@ -137,6 +161,16 @@ class ViewEventListener(sublime_plugin.ViewEventListener):
         if not self._is_modified:
             ViewCompletionManager(self.view).handle_selection_change()
 
+            # completions at the previous cursor position are useless so ask for the new position instead
+            plugin, session = CopilotPlugin.plugin_session(self.view)
+            if (
+                plugin
+                and session
+                and plugin.cancel_completion_requests_async(self.view)
+                and get_session_setting(session, "auto_ask_completions")
+            ):
+                plugin.request_get_completions(self.view)
+
         self._is_modified = False
 
 
@@ -160,11 +194,27 @@ class EventListener(sublime_plugin.EventListener):
 
         return None
 
+    def on_new(self, view: sublime.View) -> None:
+        register_view(view)
+
+    def on_clone(self, view: sublime.View) -> None:
+        register_view(view)
+
+    def on_load(self, view: sublime.View) -> None:
+        register_view(view)
+
+    def on_close(self, view: sublime.View) -> None:
+        unregister_view(view.id())
+
     def on_new_window(self, window: sublime.Window) -> None:
+        register_window(window)
         copilot_ignore_observer.add_folders(window.folders())
 
     def on_pre_close_window(self, window: sublime.Window) -> None:
         copilot_ignore_observer.remove_folders(window.folders())
+        CopilotIgnore(window).unload_patterns()
+        WindowChatPanel(window).handle_close()
+        unregister_window(window.id())
 
 
 class CopilotIgnoreHandler(FileSystemEventHandler):
@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+import threading
+
+
+class Metrics:
+    """
+    Process-wide performance counters.
+
+    Counters are plain numbers keyed by a dotted name such as `"doc_sync.bytes_saved"`.
+    They can be updated from any thread.
+    """
+
+    _lock = threading.Lock()
+    _counters: dict[str, float] = {}
+
+    @classmethod
+    def increase(cls, name: str, value: float = 1) -> None:
+        with cls._lock:
+            cls._counters[name] = cls._counters.get(name, 0) + value
+
+    @classmethod
+    def get(cls, name: str, default: float = 0) -> float:
+        with cls._lock:
+            return cls._counters.get(name, default)
+
+    @classmethod
+    def snapshot(cls) -> dict[str, float]:
+        """Return a sorted copy of all counters."""
+        with cls._lock:
+            return dict(sorted(cls._counters.items()))
+
+    @classmethod
+    def reset(cls) -> None:
+        with cls._lock:
+            cls._counters.clear()
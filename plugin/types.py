@@ -53,8 +53,12 @@ class NetworkProxy(TypedDict, total=True):
 # ------------------- #
 
 
-class CopilotDocType(TypedDict, total=True):
+class _CopilotDocTypeOptional(TypedDict, total=False):
     source: str
+    """Omitted if the server has already been synced to the same `version` of the document."""
+
+
+class CopilotDocType(_CopilotDocTypeOptional, total=True):
     tabSize: int
     indentSize: int
     insertSpaces: bool
@@ -209,7 +213,8 @@ class CopilotPayloadConversationEntryTransformed(TypedDict, total=True):
     turnId: str
     messages: list[str]
     codeBlocks: list[str]
-    codeBlockIndices: list[int]
+    """Chunks of the unfinished code block."""
+    codeBlockIds: list[str]
     references: list[CopilotRequestConversationTurnReference | CopilotGitHubWebSearch]
 
 
@@ -242,6 +247,16 @@ class CopilotRequestConversationTurnReference(TypedDict, total=True):
     activeAt: str | None
 
 
+class CopilotConversationReferenceDecision(TypedDict, total=True):
+    """Our own record of why a view is (not) referenced in a conversation turn."""
+
+    uri: str
+    status: Literal["included", "skipped"]
+    reason: str
+    chars: int
+    isCached: bool
+
+
 class CopilotGitHubWebDataResult(TypedDict, total=True):
     title: str
     excerpt: str
@@ -1,11 +1,12 @@
 from __future__ import annotations
 
-from .chat import WindowConversationManager
+from .chat import WindowChatPanel, WindowConversationManager
 from .completion import ViewCompletionManager
 from .panel_completion import ViewPanelCompletionManager
 
 __all__ = (
     "ViewCompletionManager",
     "ViewPanelCompletionManager",
+    "WindowChatPanel",
     "WindowConversationManager",
 )
@@ -1,18 +1,211 @@
 from __future__ import annotations
 
-from typing import Callable
+import threading
+import uuid
+from dataclasses import dataclass, field
+from typing import Callable, Hashable, Iterable
 
 import mdpopups
 import sublime
+from more_itertools import first_true
 
 from ..constants import COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX
-from ..helpers import GithubInfo, preprocess_message_for_html
+from ..helpers import (
+    ConversationTranscript,
+    FrameRateLimiter,
+    GithubInfo,
+    HighlightCache,
+    preprocess_message_for_html,
+)
+from ..log import log_error
+from ..metrics import Metrics
+from ..settings import get_plugin_setting_dotted
 from ..template import load_resource_template
 from ..types import CopilotPayloadConversationEntry, CopilotPayloadConversationEntryTransformed, StLayout
-from ..utils import find_view_by_id, find_window_by_id, get_copilot_setting, remove_prefix, set_copilot_setting
+from ..utils import (
+    clamp,
+    erase_copilot_setting,
+    find_view_by_id,
+    get_copilot_setting,
+    register_sheet,
+    set_copilot_setting,
+)
+
+
+class _ConversationSynthesizer:
+    """
+    Transforms conversation entries into sections of the chat panel incrementally.
+
+    Entries are fed one by one as they are appended, so a streamed chunk only touches the open section
+    and the code block state machine. Code blocks are indexed by a turn-scoped ID, `"<turn ID>:<n>"`,
+    while they are parsed, so looking one up doesn't depend on the chat panel having been rendered.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self) -> None:
+        self._sections: list[CopilotPayloadConversationEntryTransformed] = []
+        self._current_entry: CopilotPayloadConversationEntryTransformed | None = None
+        self._previous_entry: CopilotPayloadConversationEntry | None = None
+        self._is_inside_code_block = False
+        self._code_blocks: dict[str, str] = {}
+        """key = code block ID; value = code of a closed code block"""
+
+    def reset(self, entries: Iterable[CopilotPayloadConversationEntry] = ()) -> None:
+        """Forgets everything and feeds `entries` from scratch."""
+        with self._lock:
+            self._clear()
+            for entry in entries:
+                self._feed(entry)
+
+    def feed(self, entry: CopilotPayloadConversationEntry) -> None:
+        with self._lock:
+            self._feed(entry)
+
+    def sections(self) -> list[CopilotPayloadConversationEntryTransformed]:
+        """
+        Returns the sections of fed entries.
+
+        Sections are shared with later calls and must not be modified by the caller.
+        """
+        with self._lock:
+            if not (current_entry := self._current_entry):
+                return list(self._sections)
 
+            # Fixes: https://github.com/TerminalFi/LSP-copilot/issues/187
+            if self._is_inside_code_block:
+                current_entry = {**current_entry, "messages": [*current_entry["messages"], "```"]}
+            return [*self._sections, current_entry]
+
+    def code_block(self, code_block_id: str) -> str | None:
+        """Returns the code of a code block, which may be still streaming."""
+        with self._lock:
+            if (code := self._code_blocks.get(code_block_id)) is not None:
+                return code
+            if (
+                self._is_inside_code_block
+                and (current_entry := self._current_entry)
+                and current_entry["codeBlockIds"][-1:] == [code_block_id]
+            ):
+                return "".join(current_entry["codeBlocks"])
+            return None
+
+    def _open_code_block(self, current_entry: CopilotPayloadConversationEntryTransformed, reply: str) -> str:
+        code_block_id = f"{current_entry['turnId']}:{len(current_entry['codeBlockIds'])}"
+        current_entry["codeBlockIds"].append(code_block_id)
+        self._is_inside_code_block = True
+        return f"CODE_BLOCK_COMMANDS_{code_block_id}\n\n{reply}"
+
+    def _close_code_block(self, current_entry: CopilotPayloadConversationEntryTransformed) -> None:
+        self._code_blocks[current_entry["codeBlockIds"][-1]] = "".join(current_entry["codeBlocks"])
+        current_entry["codeBlocks"] = []
+        self._is_inside_code_block = False
+
+    def _feed(self, entry: CopilotPayloadConversationEntry) -> None:
+        kind = entry["kind"]
+        reply = entry["reply"]
+        turn_id = entry["turnId"]
+        current_entry = self._current_entry
+
+        if current_entry and current_entry["kind"] == kind:
+            if reply.startswith("```"):
+                if self._is_inside_code_block:
+                    self._close_code_block(current_entry)
+                else:
+                    reply = self._open_code_block(current_entry, reply)
+            elif self._is_inside_code_block:
+                current_entry["codeBlocks"].append(reply)
+            current_entry["messages"].append(reply)
+        else:
+            if current_entry:
+                # the previous section ends with an unfinished code block
+                if self._is_inside_code_block:
+                    self._close_code_block(current_entry)
+                    current_entry["messages"].append("```")
+                self._sections.append(current_entry)
+            current_entry = self._current_entry = {
+                "kind": kind,
+                "turnId": turn_id,
+                "messages": [],
+                "codeBlockIds": [],
+                "codeBlocks": [],
+                "references": [],
+            }
+            if kind == "report" and self._previous_entry:
+                current_entry["references"] = self._previous_entry.get("references", [])
+
+            if reply.startswith("```") and kind == "report":
+                reply = self._open_code_block(current_entry, reply)
+            current_entry["messages"].append(reply)
+
+        self._previous_entry = entry
+
+
+@dataclass
+class _ConversationState:
+    """
+    The in-memory state of a conversation.
+
+    Entries are only ever appended while a reply streams, so appending is O(1). They are loaded from the
+    conversation transcript on first use, and written to it by `WindowConversationManager.snapshot()`
+    at turn boundaries rather than per chunk.
+    """
+
+    window: sublime.Window
+    key: str
+    """A unique key which names the transcript and the work done token of the conversation."""
+    frame_rate_limiter: FrameRateLimiter
+    conversation_id: str = ""
+    suggested_title: str = ""
+    follow_up: str = ""
+    is_waiting: bool = False
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    """Guards loading and persisting entries."""
+    is_loaded: bool = False
+    entries: list[CopilotPayloadConversationEntry] = field(default_factory=list)
+    persisted_count: int = 0
+    """The number of leading `entries` which have been written into the transcript."""
+    needs_rewrite: bool = False
+    """Whether `entries` have been replaced, so the transcript has to be rewritten rather than appended."""
+    reference_block_state: dict[str, bool] = field(default_factory=dict)
+    synthesizer: _ConversationSynthesizer = field(default_factory=_ConversationSynthesizer)
+    older_turn_pages: int = 0
+    """The number of pages of older turns shown in the chat panel in addition to the latest page."""
+    section_html_cache: dict[tuple[str, str], tuple[Hashable, str]] = field(default_factory=dict)
+    """key = (turn ID, kind); value = (inputs of the rendering, rendered HTML)"""
+
+    @property
+    def work_done_token(self) -> str:
+        return f"copilot_chat://{self.window.id()}/{self.key}"
+
+
+@dataclass
+class _WindowConversationsState:
+    """The conversations of a window. Only the active one is shown in the chat panel."""
+
+    conversations: dict[str, _ConversationState] = field(default_factory=dict)
+    """key = conversation key; in creation order"""
+    active_key: str = ""
+
+
+_window_to_conversations_state: dict[int, _WindowConversationsState] = {}
+"""key = window ID. An entry is removed when the window is closed, so it never outlives the window."""
+
+_token_to_conversation_state: dict[str, _ConversationState] = {}
+"""key = work done token. Routes `$/progress` notifications to conversations."""
+
+
+class WindowChatPanel:
+    """
+    Manages the chat panel of a window, which is shared by all conversations of the window.
+    Unlike `WindowConversationManager`, it never creates a conversation.
+    """
+
+    def __init__(self, window: sublime.Window) -> None:
+        self.window = window
 
-class WindowConversationManager:
     # --------------- #
     # window settings #
     # --------------- #
@@ -53,271 +246,530 @@ class WindowConversationManager:
     def view_id(self, value: int) -> None:
         set_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "view_id", value)
 
+    @property
+    def is_visible(self) -> bool:
+        """Whether the converation completions is streaming."""
+        return get_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "is_visible", False)
+
+    @is_visible.setter
+    def is_visible(self, value: bool) -> None:
+        set_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "is_visible", value)
+
+    # -------------- #
+    # normal methods #
+    # -------------- #
+
+    def reset(self) -> None:
+        """Resets the chat panel of the window. Conversations and their transcripts are kept."""
+        self.is_visible = False
+        self.original_layout = None
+
+        # these used to be stored in window settings, which are persisted in the session file
+        for key in (
+            "conversation_entries",
+            "reference_block_state",
+            "code_block_index",
+            "conversation_id",
+            "suggested_title",
+            "follow_up",
+            "is_waiting_conversation",
+            "transcript_name",
+        ):
+            erase_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, key)
+
+        if view := find_view_by_id(self.view_id):
+            view.close()
+
+    def handle_close(self) -> None:
+        """
+        Forgets all conversations of the window. Their transcripts are kept since ST may be exiting,
+        or the window may be a project which is reopened later. Stale ones are deleted by
+        `WindowConversationManager.expire_transcripts()`.
+        """
+        # there is nothing to write if the conversations of the window have never been restored
+        if not (window_state := _window_to_conversations_state.get(self.window.id())):
+            return
+        for state in tuple(window_state.conversations.values()):
+            WindowConversationManager(self.window, state).snapshot()
+            _token_to_conversation_state.pop(state.work_done_token, None)
+        _window_to_conversations_state.pop(self.window.id(), None)
+
+    def close(self) -> None:
+        """Close the chat panel."""
+        if not (sheet := self.window.transient_sheet_in_group(self.group_id)):
+            return
+
+        sheet.close()
+
+        self.is_visible = False
+        self.window.run_command("hide_panel")
+        if self.original_layout:
+            self.window.set_layout(self.original_layout)  # type: ignore
+            self.original_layout = None
+
+        if view := self.window.active_view():
+            self.window.focus_view(view)
+
+
+class WindowConversationManager(WindowChatPanel):
+    """
+    Manages a conversation of a window. Use `find()` to look up an existing conversation,
+    which may be gone, and `create()` to start a new one.
+    """
+
+    # ------------------ #
+    # conversation state #
+    # ------------------ #
+
+    @property
+    def key(self) -> str:
+        """The unique key of the conversation."""
+        return self._state.key
+
+    @property
+    def work_done_token(self) -> str:
+        """The work done token of requests of the conversation."""
+        return self._state.work_done_token
+
+    @property
+    def is_active(self) -> bool:
+        """Whether the conversation is the one shown in the chat panel."""
+        return self._window_state.active_key == self._state.key
+
     @property
     def suggested_title(self) -> str:
         """Suggested title of the conversation"""
-        return get_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "suggested_title", "")
+        return self._state.suggested_title
 
     @suggested_title.setter
     def suggested_title(self, value: str) -> None:
-        set_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "suggested_title", value)
+        if self._state.suggested_title != value:
+            self._state.suggested_title = value
+            self._save_conversation_list(self.window)
 
     @property
     def follow_up(self) -> str:
         """Suggested follow up of the conversation provided by copilot."""
-        return get_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "follow_up", "")
+        return self._state.follow_up
 
     @follow_up.setter
     def follow_up(self, value: str) -> None:
         # Fixes: https://github.com/TerminalFi/LSP-copilot/issues/182
         # Replaces ` with &#96; to avoid breaking the HTML
-        set_copilot_setting(
-            self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "follow_up", value.replace("`", "&#96;")
-        )
+        self._state.follow_up = value.replace("`", "&#96;")
 
     @property
     def conversation_id(self) -> str:
         """The conversation uuid used to identify the conversation."""
-        return get_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "conversation_id", "")
+        return self._state.conversation_id
 
     @conversation_id.setter
     def conversation_id(self, value: str) -> None:
-        set_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "conversation_id", value)
-
-    @property
-    def code_block_index(self) -> dict[str, str]:
-        """The tracking of code blocks across the conversation. Used to support Copy and Insert code commands."""
-        return get_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "code_block_index", {})
-
-    @code_block_index.setter
-    def code_block_index(self, value: dict[str, str]) -> None:
-        set_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "code_block_index", value)
+        self._state.conversation_id = value
+        self._save_conversation_list(self.window)
 
     @property
     def is_waiting(self) -> bool:
         """Whether the converation completions is streaming."""
-        return get_copilot_setting(
-            self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "is_waiting_conversation", False
-        )
+        return self._state.is_waiting
 
     @is_waiting.setter
     def is_waiting(self, value: bool) -> None:
-        set_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "is_waiting_conversation", value)
-
-    @property
-    def is_visible(self) -> bool:
-        """Whether the converation completions is streaming."""
-        return get_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "is_visible", False)
-
-    @is_visible.setter
-    def is_visible(self, value: bool) -> None:
-        set_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "is_visible", value)
+        self._state.is_waiting = value
 
     @property
     def reference_block_state(self) -> dict[str, bool]:
-        return get_copilot_setting(
-            self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "reference_block_state", {}
-        )
+        """Whether the references block of a turn is expanded. Note that this is a shallow copy."""
+        return dict(self._state.reference_block_state)
 
     @reference_block_state.setter
     def reference_block_state(self, value: dict[str, bool]) -> None:
-        set_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "reference_block_state", value)
+        self._state.reference_block_state = dict(value)
+
+    @property
+    def section_html_cache(self) -> dict[tuple[str, str], tuple[Hashable, str]]:
+        """The rendered HTML of sections in the chat panel. Note that this is not a copy."""
+        return self._state.section_html_cache
 
     @property
     def conversation(self) -> list[CopilotPayloadConversationEntry]:
-        """All `conversation` in the view. Note that this is a copy."""
-        return get_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "conversation_entries", [])
+        """All `conversation` in the conversation. Note that this is a shallow copy."""
+        return list(self._entries)
 
     @conversation.setter
     def conversation(self, value: list[CopilotPayloadConversationEntry]) -> None:
-        set_copilot_setting(self.window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "conversation_entries", value)
+        with self._state.lock:
+            self._state.entries = list(value)
+            self._state.is_loaded = True
+            self._state.needs_rewrite = True
+            self._state.synthesizer.reset(self._state.entries)
+        self._state.section_html_cache.clear()
+
+    @property
+    def _entries(self) -> list[CopilotPayloadConversationEntry]:
+        """The in-memory entries. Note that this is not a copy."""
+        self._ensure_loaded()
+        return self._state.entries
+
+    def _ensure_loaded(self) -> None:
+        """Loads entries from the transcript on first use."""
+        state = self._state
+        if state.is_loaded:
+            return
+        with state.lock:
+            if state.is_loaded:
+                return
+            state.entries = ConversationTranscript(state.key).load()
+            state.synthesizer.reset(state.entries)
+            state.persisted_count = len(state.entries)
+            state.is_loaded = True
 
     # -------------- #
     # normal methods #
     # -------------- #
 
-    def __init__(self, window: sublime.Window) -> None:
-        self.window = window
+    def __init__(self, window: sublime.Window, state: _ConversationState) -> None:
+        super().__init__(window)
+        self._window_state = self._get_window_state(window)
+        self._state = state
+
+    @classmethod
+    def find(cls, window: sublime.Window, key: str | None = None) -> WindowConversationManager | None:
+        """
+        Finds the conversation by its `key`, or the active conversation if no `key` is given.
+        Returns `None` if there is no such conversation, e.g., it has been destroyed.
+        """
+        window_state = cls._get_window_state(window)
+        if not (state := window_state.conversations.get(key or window_state.active_key)):
+            return None
+        return cls(window, state)
+
+    @classmethod
+    def create(cls, window: sublime.Window) -> WindowConversationManager:
+        """Creates a conversation and makes it the active one."""
+        wcm = cls(window, cls._create_conversation(window))
+        wcm.activate()
+        return wcm
+
+    @classmethod
+    def from_token(cls, token: str) -> WindowConversationManager | None:
+        """Finds the conversation which requests with the work done token belong to."""
+        if not (state := _token_to_conversation_state.get(token)):
+            return None
+        return cls(state.window, state)
+
+    @classmethod
+    def from_conversation_id(cls, window: sublime.Window, conversation_id: str) -> WindowConversationManager | None:
+        return first_true(
+            cls.all_conversations(window),
+            pred=lambda wcm: bool(conversation_id) and wcm.conversation_id == conversation_id,
+        )
 
-    def reset(self) -> None:
-        self.is_waiting = False
-        self.is_visible = False
-        self.original_layout = None
-        self.suggested_title = ""
-        self.follow_up = ""
-        self.conversation_id = ""
+    @classmethod
+    def all_conversations(cls, window: sublime.Window) -> list[WindowConversationManager]:
+        """All conversations of the window in creation order."""
+        return [cls(window, state) for state in tuple(cls._get_window_state(window).conversations.values())]
+
+    @classmethod
+    def expire_transcripts(cls) -> None:
+        """
+        Deletes transcripts which haven't been written for "chat_transcript_max_age_days" days.
+        Transcripts of closed windows can't be told apart from those of closed projects, which are restored
+        along with their projects, so transcripts are never deleted only because no open window refers to them.
+        """
+        if (max_age_days := float(get_plugin_setting_dotted("settings.chat_transcript_max_age_days", 30))) <= 0:
+            return
+        # conversations in memory may have been used recently without being written yet
+        keys = {
+            state.key
+            for window_state in tuple(_window_to_conversations_state.values())
+            for state in tuple(window_state.conversations.values())
+        }
+        count = ConversationTranscript.expire(max_age_days * 24 * 60 * 60, keep=keys)
+        Metrics.increase("chat_panel.transcripts_expired", count)
+
+    @classmethod
+    def _get_window_state(cls, window: sublime.Window) -> _WindowConversationsState:
+        if window_state := _window_to_conversations_state.get(window.id()):
+            return window_state
+
+        # restore conversations from the last session
+        window_state = _window_to_conversations_state.setdefault(window.id(), _WindowConversationsState())
+        for item in get_copilot_setting(window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "conversations", []):
+            state = cls._create_conversation(window, item["key"], window_state)
+            state.conversation_id = item.get("conversation_id", "")
+            state.suggested_title = item.get("suggested_title", "")
+        active_key = get_copilot_setting(window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "active_key", "")
+        window_state.active_key = active_key if active_key in window_state.conversations else ""
+        return window_state
+
+    @classmethod
+    def _create_conversation(
+        cls,
+        window: sublime.Window,
+        key: str | None = None,
+        window_state: _WindowConversationsState | None = None,
+    ) -> _ConversationState:
+        window_state = window_state or cls._get_window_state(window)
+        key = key or uuid.uuid4().hex
+        state = _ConversationState(
+            window=window,
+            key=key,
+            frame_rate_limiter=FrameRateLimiter(
+                lambda: cls._render_if_active(window, key),
+                cls._max_fps,
+                name="chat_panel",
+            ),
+        )
+        state = window_state.conversations.setdefault(key, state)
+        _token_to_conversation_state[state.work_done_token] = state
+        return state
+
+    @classmethod
+    def _render_if_active(cls, window: sublime.Window, key: str) -> None:
+        # each conversation has its own render loop but only the active one is shown
+        window_state = _window_to_conversations_state.get(window.id())
+        if window_state and window_state.active_key == key and (state := window_state.conversations.get(key)):
+            _ConversationEntry(cls(window, state)).update()
+
+    @classmethod
+    def _save_conversation_list(cls, window: sublime.Window) -> None:
+        """Saves the list of conversations, which point to their transcripts, into window settings."""
+        window_state = cls._get_window_state(window)
+        items = [
+            {"key": state.key, "conversation_id": state.conversation_id, "suggested_title": state.suggested_title}
+            for state in tuple(window_state.conversations.values())
+        ]
+        set_copilot_setting(window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "conversations", items)
+        set_copilot_setting(window, COPILOT_WINDOW_CONVERSATION_SETTINGS_PREFIX, "active_key", window_state.active_key)
+
+    def activate(self) -> None:
+        """Makes the conversation the one shown in the chat panel."""
+        self._window_state.active_key = self._state.key
+        self._save_conversation_list(self.window)
+
+    def destroy(self) -> None:
+        """
+        Removes the conversation. If there are other conversations, the latest one becomes active.
+        Otherwise, the chat panel is closed.
+        """
+        was_active = self.is_active
+        self._remove()
+        if not (conversations := self.all_conversations(self.window)):
+            self.close()
+            self.reset()
+            return
+
+        if was_active:
+            conversations[-1].activate()
+        self._save_conversation_list(self.window)
+        if self.is_visible:
+            conversations[-1].update(immediately=True)
+
+    def _remove(self) -> None:
+        state = self._state
+        state.is_waiting = False
         self.conversation = []
-        self.reference_block_state = {}
-        self.code_block_index = {}
+        self.snapshot()
+        self._window_state.conversations.pop(state.key, None)
+        _token_to_conversation_state.pop(state.work_done_token, None)
+        if self._window_state.active_key == state.key:
+            self._window_state.active_key = ""
 
-        if view := find_view_by_id(self.view_id):
-            view.close()
+    @property
+    def max_visible_turns(self) -> int:
+        """The maximum number of turns rendered in the chat panel."""
+        page_size = max(int(get_plugin_setting_dotted("settings.chat_panel_page_size", 20)), 1)
+        return page_size * (self._state.older_turn_pages + 1)
+
+    def show_older_turns(self) -> None:
+        """Pages in older turns into the chat panel."""
+        self._state.older_turn_pages += 1
+
+    @staticmethod
+    def _max_fps() -> float:
+        return clamp(get_plugin_setting_dotted("settings.chat_panel_max_fps", 20), 1, 60)
+
+    def snapshot(self) -> None:
+        """Write in-memory entries, which haven't been written yet, into the conversation transcript."""
+        state = self._state
+        with state.lock:
+            if not state.is_loaded:
+                return
+
+            transcript = ConversationTranscript(state.key)
+            try:
+                if not state.entries:
+                    transcript.delete()
+                elif state.needs_rewrite:
+                    transcript.rewrite(state.entries)
+                elif state.persisted_count < len(state.entries):
+                    transcript.append(state.entries[state.persisted_count :])
+            except OSError as e:
+                log_error(f"Failed to write conversation transcript {transcript.path}: {e}")
+                return
+
+            state.persisted_count = len(state.entries)
+            state.needs_rewrite = False
 
     def append_conversation_entry(self, entry: CopilotPayloadConversationEntry) -> None:
-        # `self.conversation` is a deepcopy of the original value
-        # So if we do `self.conversation.append(entry)`, the source value won't be modified
-        conversation_history = self.conversation
-        conversation_history.append(entry)
-        self.conversation = conversation_history
-        self.append_reference_block_state(entry["turnId"], False)
-
-    def append_reference_block_state(self, turn_id: str, state: bool) -> None:
-        # `self.reference_block_state` is a deepcopy of the original value
-        # So if we do self.`reference_block_state[turn_id] = state`, the source value won't be modified
-        reference_block_state = self.reference_block_state
-        reference_block_state[turn_id] = state
-        self.reference_block_state = reference_block_state
-
-    def insert_code_block_index(self, index: int, code_block: str) -> None:
-        # `self.code_block_index` is a deepcopy of the original value
-        # So if we do `self.code_block_index[str(index)] = code_block_index`, the source value won't be modified
-        code_block_index = self.code_block_index
-        code_block_index[str(index)] = code_block
-        self.code_block_index = code_block_index
+        self._entries.append(entry)
+        self._state.synthesizer.feed(entry)
+        self._state.reference_block_state.setdefault(entry["turnId"], False)
 
-    def toggle_references_block(self, turn_id: str) -> None:
-        reference_block_state = self.reference_block_state
-        reference_block_state.setdefault(turn_id, False)
-        reference_block_state[turn_id] = not reference_block_state[turn_id]
-        self.reference_block_state = reference_block_state
+    def synthesize(self) -> list[CopilotPayloadConversationEntryTransformed]:
+        """Transforms the conversation into sections of the chat panel."""
+        self._ensure_loaded()
+        return self._state.synthesizer.sections()
 
-    @staticmethod
-    def find_window_by_token_id(token_id: str) -> sublime.Window | None:
-        window_id = int(remove_prefix(token_id, "copilot_chat://"))
-        return find_window_by_id(window_id)
+    def code_block(self, code_block_id: str) -> str | None:
+        """Returns the code of a code block in the conversation."""
+        self._ensure_loaded()
+        return self._state.synthesizer.code_block(code_block_id)
+
+    def is_references_expanded(self, turn_id: str) -> bool:
+        return self._state.reference_block_state.get(turn_id, False)
+
+    def toggle_references_block(self, turn_id: str) -> None:
+        reference_block_state = self._state.reference_block_state
+        reference_block_state[turn_id] = not reference_block_state.get(turn_id, False)
 
     def prompt(self, callback: Callable[[str], None], initial_text: str = "") -> None:
         self.window.show_input_panel("Copilot Chat", initial_text, callback, None, None)
 
     def open(self) -> None:
-        _ConversationEntry(self.window).open()
+        _ConversationEntry(self).open()
 
-    def update(self) -> None:
-        """Update the completion panel."""
-        _ConversationEntry(self.window).update()
-
-    def close(self) -> None:
-        """Close the completion panel."""
-        _ConversationEntry(self.window).close()
+    def update(self, *, immediately: bool = False) -> None:
+        """
+        Update the completion panel. Updates are merged so that the panel is rendered at most
+        "chat_panel_max_fps" times per second, unless `immediately` is set.
+        """
+        self._state.frame_rate_limiter.request(immediately=immediately)
 
 
 class _ConversationEntry:
-    def __init__(self, window: sublime.Window) -> None:
-        self.window = window
-        self.wcm = WindowConversationManager(window)
+    def __init__(self, wcm: WindowConversationManager) -> None:
+        self.window = wcm.window
+        self.wcm = wcm
 
     @property
     def completion_content(self) -> str:
-        conversations_entries = self._synthesize()
-        return load_resource_template("chat_panel.md.jinja", keep_trailing_newline=True).render(
-            window_id=self.wcm.window.id(),
+        """The HTML content of the chat panel."""
+        # the same dummy view which `mdpopups` uses to convert markdown for HTML sheets
+        view = self.window.create_output_panel("mdpopups-dummy", unlisted=True)
+        window_id = self.window.id()
+        sections = self.wcm.synthesize()
+        first_visible = self._first_visible_section_index(sections, self.wcm.max_visible_turns)
+        header = load_resource_template("chat_panel.md.jinja", keep_trailing_newline=True).render(
+            has_older_turns=first_visible > 0,
+            show_older_url=sublime.command_url(
+                "copilot_conversation_show_older_turns",
+                {"window_id": window_id, "key": self.wcm.key},
+            ),
             is_waiting=self.wcm.is_waiting,
-            avatar_img_src=GithubInfo.get_avatar_img_src(),
             suggested_title=preprocess_message_for_html(self.wcm.suggested_title),
-            follow_up=preprocess_message_for_html(self.wcm.follow_up),
-            follow_up_url=sublime.command_url(
-                "copilot_conversation_chat_shim",
-                {"window_id": self.wcm.window.id(), "message": self.wcm.follow_up},
-            ),
-            close_url=sublime.command_url(
-                "copilot_conversation_close",
-                {"window_id": self.wcm.window.id()},
-            ),
+            close_url=sublime.command_url("copilot_conversation_close", {"window_id": window_id}),
+            conversation_count=len(WindowConversationManager.all_conversations(self.window)),
+            switch_url=sublime.command_url("copilot_conversation_switch"),
             delete_url=sublime.command_url(
                 "copilot_conversation_destroy_shim",
                 {"conversation_id": self.wcm.conversation_id},
             ),
-            sections=[
-                {
-                    "kind": entry["kind"],
-                    "message": "".join(entry["messages"]),
-                    "code_block_indices": entry["codeBlockIndices"],
-                    "toggle_references_url": sublime.command_url(
-                        "copilot_conversation_toggle_references_block",
-                        {
-                            "conversation_id": self.wcm.conversation_id,
-                            "window_id": self.wcm.window.id(),
-                            "turn_id": entry["turnId"],
-                        },
-                    ),
-                    "references": [] if entry["kind"] != "report" else entry["references"],
-                    "references_expanded": self.wcm.reference_block_state.get(entry["turnId"], False),
-                    "turn_delete_url": sublime.command_url(
-                        "copilot_conversation_turn_delete_shim",
-                        {
-                            "conversation_id": self.wcm.conversation_id,
-                            "window_id": self.wcm.window.id(),
-                            "turn_id": entry["turnId"],
-                        },
-                    ),
-                    "thumbs_up_url": sublime.command_url(
-                        "copilot_conversation_rating_shim",
-                        {"turn_id": entry["turnId"], "rating": 1},
-                    ),
-                    "thumbs_down_url": sublime.command_url(
-                        "copilot_conversation_rating_shim",
-                        {"turn_id": entry["turnId"], "rating": -1},
-                    ),
-                }
-                for entry in conversations_entries
-            ],
         )
+        follow_up = load_resource_template("chat_panel_follow_up.md.jinja", keep_trailing_newline=True).render(
+            follow_up=preprocess_message_for_html(self.wcm.follow_up),
+            follow_up_url=sublime.command_url(
+                "copilot_conversation_chat_shim",
+                {"window_id": window_id, "message": self.wcm.follow_up},
+            ),
+        )
+        return "".join((
+            mdpopups.md2html(view, header),
+            *(
+                # the last section is still streaming while waiting for the reply
+                self._render_section(view, section, is_streaming=self.wcm.is_waiting and idx == len(sections) - 1)
+                for idx, section in enumerate(sections[first_visible:], first_visible)
+            ),
+            mdpopups.md2html(view, follow_up),
+        ))
 
-    def _synthesize(self) -> list[CopilotPayloadConversationEntryTransformed]:
-        def inject_code_block_commands(reply: str, code_block_index: int) -> str:
-            return f"CODE_BLOCK_COMMANDS_{code_block_index}\n\n{reply}"
-
-        transformed_conversation: list[CopilotPayloadConversationEntryTransformed] = []
-        current_entry: CopilotPayloadConversationEntryTransformed | None = None
-        is_inside_code_block = False
-        code_block_index = -1
-
-        for idx, entry in enumerate(self.wcm.conversation):
-            kind = entry["kind"]
-            reply = entry["reply"]
-            turn_id = entry["turnId"]
-
-            if current_entry and current_entry["kind"] == kind:
-                if reply.startswith("```"):
-                    is_inside_code_block = not is_inside_code_block
-                    if is_inside_code_block:
-                        code_block_index += 1
-                        current_entry["codeBlockIndices"].append(code_block_index)
-                        reply = inject_code_block_commands(reply, code_block_index)
-                    else:
-                        self.wcm.insert_code_block_index(code_block_index, "".join(current_entry["codeBlocks"]))
-                        current_entry["codeBlocks"] = []
-                elif is_inside_code_block:
-                    current_entry["codeBlocks"].append(reply)
-                current_entry["messages"].append(reply)
-            else:
-                if current_entry:
-                    transformed_conversation.append(current_entry)
-                current_entry = {
-                    "kind": kind,
-                    "turnId": turn_id,
-                    "messages": [reply],
-                    "codeBlockIndices": [],
-                    "codeBlocks": [],
-                    "references": [],
-                }
-                if kind == "report":
-                    current_entry["references"] = self.wcm.conversation[idx - 1].get("references", [])
-
-                if reply.startswith("```") and kind == "report":
-                    is_inside_code_block = True
-                    code_block_index += 1
-                    current_entry["codeBlockIndices"].append(code_block_index)
-                    reply = inject_code_block_commands(reply, code_block_index)
-                    current_entry["messages"] = [reply]
-
-        if current_entry:
-            # Fixes: https://github.com/TerminalFi/LSP-copilot/issues/187
-            if is_inside_code_block:
-                current_entry["messages"].append("```")
-            transformed_conversation.append(current_entry)
-
-        return transformed_conversation
+    @staticmethod
+    def _first_visible_section_index(
+        sections: list[CopilotPayloadConversationEntryTransformed],
+        max_turns: int,
+    ) -> int:
+        """Returns the index of the first section of the last `max_turns` turns. Older sections are not rendered."""
+        turn_ids: set[str] = set()
+        first_visible = len(sections)
+        for idx in range(len(sections) - 1, -1, -1):
+            if (turn_id := sections[idx]["turnId"]) not in turn_ids:
+                if len(turn_ids) == max_turns:
+                    break
+                turn_ids.add(turn_id)
+            first_visible = idx
+        return first_visible
+
+    def _render_section(
+        self,
+        view: sublime.View,
+        entry: CopilotPayloadConversationEntryTransformed,
+        *,
+        is_streaming: bool = False,
+    ) -> str:
+        """
+        Renders a section into HTML. The result is cached until any input of the section changes,
+        unless the section `is_streaming`, whose every snapshot is only rendered once.
+        """
+        conversation_id = self.wcm.conversation_id
+        turn_id = entry["turnId"]
+        references_expanded = self.wcm.is_references_expanded(turn_id)
+        avatar_img_src = GithubInfo.get_avatar_img_src()
+        # messages are only appended, except the closing fence of an unfinished code block at the very end,
+        # so the count and the last message identify the content
+        messages = entry["messages"]
+        inputs = (conversation_id, len(messages), messages[-1], references_expanded, avatar_img_src)
+
+        section_html_cache = self.wcm.section_html_cache
+        cache_key = (turn_id, entry["kind"])
+        if (cached := section_html_cache.get(cache_key)) and cached[0] == inputs:
+            Metrics.increase("chat_panel.section_cache.hits")
+            return cached[1]
+        Metrics.increase("chat_panel.section_cache.misses")
+
+        window_id = self.window.id()
+        markdown = load_resource_template("chat_panel_section.md.jinja", keep_trailing_newline=True).render(
+            window_id=window_id,
+            conversation_key=self.wcm.key,
+            avatar_img_src=avatar_img_src,
+            section={
+                "kind": entry["kind"],
+                "message": HighlightCache.highlight_markdown(view, "".join(messages), is_streaming=is_streaming),
+                "code_block_ids": entry["codeBlockIds"],
+                "toggle_references_url": sublime.command_url(
+                    "copilot_conversation_toggle_references_block",
+                    {"conversation_id": conversation_id, "window_id": window_id, "turn_id": turn_id},
+                ),
+                "references": [] if entry["kind"] != "report" else entry["references"],
+                "references_expanded": references_expanded,
+                "turn_delete_url": sublime.command_url(
+                    "copilot_conversation_turn_delete_shim",
+                    {"conversation_id": conversation_id, "window_id": window_id, "turn_id": turn_id},
+                ),
+                "thumbs_up_url": sublime.command_url(
+                    "copilot_conversation_rating_shim",
+                    {"turn_id": turn_id, "rating": 1},
+                ),
+                "thumbs_down_url": sublime.command_url(
+                    "copilot_conversation_rating_shim",
+                    {"turn_id": turn_id, "rating": -1},
+                ),
+            },
+        )
+        html = mdpopups.md2html(view, markdown)
+        if not is_streaming:
+            section_html_cache[cache_key] = (inputs, html)
+        return html
 
     def open(self) -> None:
         self.wcm.is_visible = True
@@ -333,22 +785,7 @@ class _ConversationEntry:
         if not (sheet := self.window.transient_sheet_in_group(self.wcm.group_id)):
             return
 
-        mdpopups.update_html_sheet(sheet=sheet, contents=self.completion_content, md=True, wrapper_class="wrapper")
-
-    def close(self) -> None:
-        if not (sheet := self.window.transient_sheet_in_group(self.wcm.group_id)):
-            return
-
-        sheet.close()
-
-        self.wcm.is_visible = False
-        self.wcm.window.run_command("hide_panel")
-        if self.wcm.original_layout:
-            self.window.set_layout(self.wcm.original_layout)  # type: ignore
-            self.wcm.original_layout = None
-
-        if view := self.window.active_view():
-            self.window.focus_view(view)
+        mdpopups.update_html_sheet(sheet=sheet, contents=self.completion_content, md=False, wrapper_class="wrapper")
 
     def _open_in_group(self, window: sublime.Window, group_id: int) -> None:
         self.wcm.group_id = group_id
@@ -358,10 +795,11 @@ class _ConversationEntry:
             window=window,
             name="Copilot Chat",
             contents=self.completion_content,
-            md=True,
+            md=False,
             flags=sublime.TRANSIENT,
             wrapper_class="wrapper",
         )
+        register_sheet(sheet)
         self.wcm.view_id = sheet.id()
 
     def _open_in_side_by_side(self, window: sublime.Window) -> None:
@@ -3,16 +3,20 @@ from __future__ import annotations
 import html
 import textwrap
 from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
 from typing import Sequence
 
 import mdpopups
 import sublime
 from more_itertools import first_true
 
+from ..helpers import HighlightCache, st_point_to_lsp_position, st_region_to_lsp_range
 from ..template import load_resource_template
 from ..types import CopilotPayloadCompletion
 from ..utils import (
     clamp,
+    erase_copilot_view_setting,
+    find_index_by_key_value,
     fix_completion_syntax_highlight,
     get_copilot_view_setting,
     get_view_language_id,
@@ -23,59 +27,92 @@ from ..utils import (
 _view_to_phantom_set: dict[int, sublime.PhantomSet] = {}
 
 
+@dataclass
+class _ViewCompletionState:
+    """
+    The in-memory completion state of a view.
+
+    Thread-safety: the state is read and written from both the UI thread (commands, `on_query_context`)
+    and ST's async thread (event listeners, server responses). A single attribute read or write is atomic
+    with the GIL, and `completions` is never mutated in-place but replaced as a whole. So a reader always
+    sees either the old or the new list, which is fine for what a reader does with it.
+    """
+
+    completions: list[CopilotPayloadCompletion] = field(default_factory=list)
+    completion_index: int = 0
+    completion_style: str = ""
+    has_fetched_cycling: bool = False
+    is_visible: bool = False
+    is_waiting: bool = False
+    text_after_point: str = ""
+    """The text between the point of the shown completion and the end of its line, when it's shown."""
+
+
+_view_to_completion_state: dict[int, _ViewCompletionState] = {}
+"""key = view ID. An entry is removed when the view is closed, so it never outlives the view."""
+
+
 class ViewCompletionManager:
-    # ------------- #
-    # view settings #
-    # ------------- #
+    # ---------- #
+    # view state #
+    # ---------- #
 
     @property
     def is_visible(self) -> bool:
         """Whether Copilot's completion popup is visible."""
-        return get_copilot_view_setting(self.view, "is_visible", False)
+        return self._state.is_visible
 
     @is_visible.setter
     def is_visible(self, value: bool) -> None:
-        set_copilot_view_setting(self.view, "is_visible", value)
+        self._state.is_visible = value
+        # mirrored to view settings for key binding contexts such as "setting.copilot.completion.is_visible"
+        if get_copilot_view_setting(self.view, "is_visible", None) != value:
+            set_copilot_view_setting(self.view, "is_visible", value)
 
     @property
     def is_waiting(self) -> bool:
         """Whether the view is waiting for Copilot's completion response."""
-        return get_copilot_view_setting(self.view, "is_waiting_completion", False)
+        return self._state.is_waiting
 
     @is_waiting.setter
     def is_waiting(self, value: bool) -> None:
-        set_copilot_view_setting(self.view, "is_waiting_completion", value)
+        self._state.is_waiting = value
 
     @property
     def completions(self) -> list[CopilotPayloadCompletion]:
-        """All `completions` in the view. Note that this is a copy."""
-        return get_copilot_view_setting(self.view, "completions", [])
+        """All `completions` in the view. Note that this is a shallow copy."""
+        return list(self._state.completions)
 
     @completions.setter
     def completions(self, value: list[CopilotPayloadCompletion]) -> None:
-        set_copilot_view_setting(self.view, "completions", value)
+        self._state.completions = list(value)
 
     @property
     def completion_style(self) -> str:
         """The completion style."""
-        return get_copilot_view_setting(self.view, "completion_style", "")
+        return self._state.completion_style
 
     @completion_style.setter
     def completion_style(self, value: str) -> None:
-        set_copilot_view_setting(self.view, "completion_style", value)
+        self._state.completion_style = value
+
+    @property
+    def has_fetched_cycling(self) -> bool:
+        """Whether alternative completions have been fetched for the current position."""
+        return self._state.has_fetched_cycling
+
+    @has_fetched_cycling.setter
+    def has_fetched_cycling(self, value: bool) -> None:
+        self._state.has_fetched_cycling = value
 
     @property
     def completion_index(self) -> int:
         """The index of the current chosen completion."""
-        return get_copilot_view_setting(self.view, "completion_index", 0)
+        return self._state.completion_index
 
     @completion_index.setter
     def completion_index(self, value: int) -> None:
-        set_copilot_view_setting(
-            self.view,
-            "completion_index",
-            self._tidy_completion_index(value),
-        )
+        self._state.completion_index = self._tidy_completion_index(value)
 
     # -------------- #
     # normal methods #
@@ -83,15 +120,25 @@ class ViewCompletionManager:
 
     def __init__(self, view: sublime.View) -> None:
         self.view = view
+        self._state = _view_to_completion_state.setdefault(view.id(), _ViewCompletionState())
 
     def reset(self) -> None:
         self.is_visible = False
         self.is_waiting = False
 
+        # these used to be stored in view settings, which are persisted in the session file
+        for key in ("completions", "completion_index", "completion_style", "is_waiting_completion"):
+            erase_copilot_view_setting(self.view, key)
+
     @property
     def current_completion(self) -> CopilotPayloadCompletion | None:
         """The current chosen `completion`."""
-        return self.completions[self.completion_index] if self.completions else None
+        # `completions` may be replaced asynchronously after the index is tidied, so it's validated against the
+        # very list which is indexed
+        completions = self._state.completions
+        if not completions:
+            return None
+        return completions[clamp(self._state.completion_index, 0, len(completions) - 1)]
 
     @property
     def completion_style_type(self) -> type[_BaseCompletion]:
@@ -106,20 +153,58 @@ class ViewCompletionManager:
     def is_phantom(self) -> bool:
         return self.completion_style == _PhantomCompletion.name
 
-    def show_previous_completion(self) -> None:
-        """Show the previous completion."""
-        self.show(completion_index=self.completion_index - 1)
-
-    def show_next_completion(self) -> None:
-        """Show the next completion."""
-        self.show(completion_index=self.completion_index + 1)
-
     def handle_selection_change(self) -> None:
         if not (self.is_phantom and self.is_visible):
             return
 
         self.hide()
 
+    def handle_type_ahead(self) -> bool:
+        """
+        If the user has typed the beginning of the visible completion, trim the typed text from completions
+        and keep the completion visible. Returns whether the completion is kept.
+        """
+        if not (
+            self.is_visible
+            and (completion := self.current_completion)
+            and len(sel := self.view.sel()) == 1
+            and sel[0].empty()
+            and completion["point"] < (caret := sel[0].b)
+        ):
+            return False
+
+        point = completion["point"]
+        typed = self.view.substr(sublime.Region(point, caret))
+        if "\n" in typed:
+            return False
+        # something else is inserted too, e.g., a closing bracket which is auto-paired with the typed one
+        if self.view.substr(sublime.Region(caret, self.view.line(caret).end())) != self._state.text_after_point:
+            return False
+
+        def is_typed_ahead(completion: CopilotPayloadCompletion) -> bool:
+            return (
+                completion["point"] == point
+                and len(completion["displayText"]) > len(typed)
+                and completion["displayText"].startswith(typed)
+                and completion["text"].startswith(self.view.substr(sublime.Region(completion["region"][0], caret)))
+            )
+
+        if not is_typed_ahead(completion):
+            return False
+
+        # copy completions because `self.completions` is a shallow copy
+        completions = [completion_.copy() for completion_ in self._state.completions if is_typed_ahead(completion_)]
+        for completion_ in completions:
+            completion_["displayText"] = completion_["displayText"][len(typed) :]
+            completion_["point"] = caret
+            completion_["position"] = st_point_to_lsp_position(caret, self.view)
+            # the text after the caret is unchanged so the region end keeps its distance from the caret
+            completion_["region"] = (completion_["region"][0], caret + completion_["region"][1] - point)
+            completion_["range"] = st_region_to_lsp_range(sublime.Region(*completion_["region"]), self.view)
+
+        self.show(completions, find_index_by_key_value(completions, "uuid", completion["uuid"]))
+        return True
+
     def handle_text_change(self) -> None:
         if not (self.is_phantom and self.is_visible):
             return
@@ -127,6 +212,8 @@ class ViewCompletionManager:
         self.hide()
 
     def handle_close(self) -> None:
+        _view_to_completion_state.pop(self.view.id(), None)
+
         if not self.is_phantom:
             return
 
@@ -166,13 +253,14 @@ class ViewCompletionManager:
         if completion["text"] == self.view.substr(current_line):
             return
 
-        self.completion_style_type(self.view, completion, self.completion_index, len(self.completions)).show()
+        self.completion_style_type(self.view, completion, self.completion_index, len(self._state.completions)).show()
 
+        self._state.text_after_point = self.view.substr(sublime.Region(completion["point"], current_line.end()))
         self.is_visible = True
 
     def _tidy_completion_index(self, index: int) -> int:
         """Revise `completion_index` to a valid value, or `0` if `self.completions` is empty."""
-        completions_cnt = len(self.completions)
+        completions_cnt = len(self._state.completions)
         if not completions_cnt:
             return 0
 
@@ -219,11 +307,14 @@ class _PopupCompletion(_BaseCompletion):
     @property
     def popup_content(self) -> str:
         return load_resource_template("completion@popup.md.jinja").render(
-            code=self.popup_code,
+            code_html=HighlightCache.highlight(
+                self.view,
+                self.popup_code,
+                get_view_language_id(self.view, self.completion["point"]),
+            ),
             completion=self.completion,
             count=self.count,
             index=self.index,
-            lang=get_view_language_id(self.view, self.completion["point"]),
         )
 
     @property
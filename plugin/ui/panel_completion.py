@@ -1,24 +1,63 @@
 from __future__ import annotations
 
+import bisect
 import textwrap
-from collections.abc import Iterable
+import threading
+from dataclasses import dataclass, field
 
 import mdpopups
 import sublime
-from more_itertools import first_true, unique_everseen
+from more_itertools import first_true
 
+from ..helpers import FrameRateLimiter, HighlightCache
+from ..metrics import Metrics
+from ..settings import get_plugin_setting_dotted
 from ..template import load_resource_template
 from ..types import CopilotPayloadPanelSolution, StLayout
 from ..utils import (
     all_views,
+    clamp,
     find_view_by_id,
     fix_completion_syntax_highlight,
     get_copilot_view_setting,
     get_view_language_id,
+    register_sheet,
     remove_prefix,
     set_copilot_view_setting,
+    unregister_sheet,
 )
 
+_sheet_id_to_view_id: dict[int, int] = {}
+"""The panel completion sheet ID to its source view ID."""
+
+
+@dataclass
+class _ViewPanelCompletionState:
+    """
+    The in-memory panel completion state of a view.
+
+    `completions` are kept in the arrival order because accept URLs refer to a completion by its index.
+    `ranking` holds the indexes of unique completions sorted by score (descending). It's maintained by
+    insertion while solutions stream in, with `negated_scores` as its parallel bisection key.
+    """
+
+    frame_rate_limiter: FrameRateLimiter
+    generation: int = 0
+    """Bumped whenever panel completions are (re)requested or stopped, so late solutions can be told apart."""
+    request_id: int | None = None
+    """The ID of the in-flight `getPanelCompletions` request."""
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    completions: list[CopilotPayloadPanelSolution] = field(default_factory=list)
+    completion_texts: set[str] = field(default_factory=set)
+    ranking: list[int] = field(default_factory=list)
+    negated_scores: list[float] = field(default_factory=list)
+    section_html_cache: dict[int, str] = field(default_factory=dict)
+    """key = completion index. A completion never changes, so neither does its rendered section."""
+
+
+_view_to_panel_completion_state: dict[int, _ViewPanelCompletionState] = {}
+"""key = view ID. An entry is removed when the view is closed, so it never outlives the view."""
+
 
 class ViewPanelCompletionManager:
     # ------------- #
@@ -59,6 +98,9 @@ class ViewPanelCompletionManager:
 
     @sheet_id.setter
     def sheet_id(self, value: int) -> None:
+        _sheet_id_to_view_id.pop(self.sheet_id, None)
+        if value != -1:
+            _sheet_id_to_view_id[value] = self.view.id()
         set_copilot_view_setting(self.view, "panel_sheet_id", value)
 
     @property
@@ -79,19 +121,60 @@ class ViewPanelCompletionManager:
     def completion_target_count(self, value: int) -> None:
         set_copilot_view_setting(self.view, "panel_completion_target_count", value)
 
+    @property
+    def line_offset(self) -> int:
+        """The row of the first line sent to the server, if only a part of the document was sent."""
+        return get_copilot_view_setting(self.view, "panel_line_offset", 0)
+
+    @line_offset.setter
+    def line_offset(self, value: int) -> None:
+        set_copilot_view_setting(self.view, "panel_line_offset", value)
+
+    @property
+    def panel_id(self) -> str:
+        """The panel ID sent to Copilot `getPanelCompletions` request."""
+        return f"copilot://{self.view.id()}/{self.generation}"
+
+    # ---------- #
+    # view state #
+    # ---------- #
+
+    @property
+    def generation(self) -> int:
+        """The generation of panel completions. Solutions of other generations are dropped."""
+        return self._state.generation
+
+    @property
+    def request_id(self) -> int | None:
+        """The ID of the in-flight `getPanelCompletions` request."""
+        return self._state.request_id
+
+    @request_id.setter
+    def request_id(self, value: int | None) -> None:
+        self._state.request_id = value
+
     @property
     def completions(self) -> list[CopilotPayloadPanelSolution]:
-        """All `completions` in the view. Note that this is a copy."""
-        return get_copilot_view_setting(self.view, "panel_completions", [])
+        """All `completions` in the view, in the arrival order. Note that this is a copy."""
+        with self._state.lock:
+            return list(self._state.completions)
 
     @completions.setter
     def completions(self, value: list[CopilotPayloadPanelSolution]) -> None:
-        set_copilot_view_setting(self.view, "panel_completions", value)
+        state = self._state
+        with state.lock:
+            state.completions = []
+            state.completion_texts = set()
+            state.ranking = []
+            state.negated_scores = []
+            state.section_html_cache = {}
+        for completion in value:
+            self.append_completion(completion)
 
     @property
-    def panel_id(self) -> str:
-        """The panel ID sent to Copilot `getPanelCompletions` request."""
-        return f"copilot://{self.view.id()}"
+    def section_html_cache(self) -> dict[int, str]:
+        """The rendered HTML of completions, keyed by the completion index."""
+        return self._state.section_html_cache
 
     # -------------- #
     # normal methods #
@@ -99,6 +182,18 @@ class ViewPanelCompletionManager:
 
     def __init__(self, view: sublime.View) -> None:
         self.view = view
+        if not (state := _view_to_panel_completion_state.get(view.id())):
+            state = _view_to_panel_completion_state.setdefault(
+                view.id(),
+                _ViewPanelCompletionState(
+                    frame_rate_limiter=FrameRateLimiter(
+                        lambda: _PanelCompletion(view).update(),
+                        self._max_fps,
+                        name="panel_completion",
+                    )
+                ),
+            )
+        self._state = state
 
     def reset(self) -> None:
         self.is_waiting = False
@@ -106,24 +201,79 @@ class ViewPanelCompletionManager:
         self.original_layout = None
 
     def get_completion(self, index: int) -> CopilotPayloadPanelSolution | None:
-        try:
-            return self.completions[index]
-        except IndexError:
-            return None
+        with self._state.lock:
+            try:
+                return self._state.completions[index]
+            except IndexError:
+                return None
+
+    def append_completion(self, completion: CopilotPayloadPanelSolution) -> bool:
+        """Appends a completion and ranks it if it's unique. Returns whether it's unique."""
+        state = self._state
+        with state.lock:
+            index = len(state.completions)
+            state.completions.append(completion)
+            if (text := completion["completionText"]) in state.completion_texts:
+                return False
+            state.completion_texts.add(text)
+            # `bisect_right` keeps the arrival order among completions with the same score
+            position = bisect.bisect_right(state.negated_scores, -completion["score"])
+            state.negated_scores.insert(position, -completion["score"])
+            state.ranking.insert(position, index)
+            return True
+
+    def ranked_completions(self) -> list[tuple[int, CopilotPayloadPanelSolution]]:
+        """Returns unique completions sorted by `score` in the form of `[(completion_index, completion), ...]`."""
+        with self._state.lock:
+            return [(index, self._state.completions[index]) for index in self._state.ranking]
+
+    def handle_close(self) -> None:
+        _sheet_id_to_view_id.pop(self.sheet_id, None)
+        _view_to_panel_completion_state.pop(self.view.id(), None)
+
+    def new_generation(self) -> int:
+        """Supersedes the current generation of panel completions. Returns the new generation."""
+        with self._state.lock:
+            self._state.generation += 1
+            return self._state.generation
+
+    def supersede(self, generation: int) -> bool:
+        """Supersedes `generation` of panel completions if it's still the current one. Returns whether it was."""
+        with self._state.lock:
+            if self._state.generation != generation:
+                return False
+            self._state.generation += 1
+            return True
 
-    def append_completion(self, completion: CopilotPayloadPanelSolution) -> None:
-        completions = self.completions
-        completions.append(completion)
-        self.completions = completions
-
-    @staticmethod
-    def find_view_by_panel_id(panel_id: str) -> sublime.View | None:
-        view_id = int(remove_prefix(panel_id, "copilot://"))
-        return find_view_by_id(view_id)
+    @classmethod
+    def from_panel_id(cls, panel_id: str) -> ViewPanelCompletionManager | None:
+        """Returns the manager of the panel ID, unless the view is gone or the panel ID has been superseded."""
+        view_id, _, generation = remove_prefix(panel_id, "copilot://").partition("/")
+        if not (view := find_view_by_id(int(view_id))):
+            return None
+        if (self := cls(view)).generation != int(generation or 0):
+            Metrics.increase("panel_completion.superseded_notifications")
+            return None
+        return self
 
     @classmethod
     def from_sheet_id(cls, sheet_id: int) -> ViewPanelCompletionManager | None:
-        return first_true(map(cls, all_views()), pred=lambda self: self.sheet_id == sheet_id)
+        if (view_id := _sheet_id_to_view_id.get(sheet_id)) and (view := find_view_by_id(view_id)):
+            if (vcm := cls(view)).sheet_id == sheet_id:
+                return vcm
+            _sheet_id_to_view_id.pop(sheet_id, None)
+
+        # view settings survive plugin reloading but the in-memory index doesn't,
+        # so views are scanned by the setting without building a manager for each of them
+        if not (
+            view := first_true(
+                all_views(),
+                pred=lambda view: get_copilot_view_setting(view, "panel_sheet_id", -1) == sheet_id,
+            )
+        ):
+            return None
+        _sheet_id_to_view_id[sheet_id] = view.id()
+        return cls(view)
 
     def open(self, *, completion_target_count: int | None = None) -> None:
         """Open the completion panel."""
@@ -132,14 +282,21 @@ class ViewPanelCompletionManager:
 
         _PanelCompletion(self.view).open()
 
-    def update(self) -> None:
-        """Update the completion panel."""
-        _PanelCompletion(self.view).update()
+    def update(self, *, immediately: bool = False) -> None:
+        """
+        Update the completion panel. Updates are merged so that the panel is rendered at most
+        "panel_completion_max_fps" times per second, unless `immediately` is set.
+        """
+        self._state.frame_rate_limiter.request(immediately=immediately)
 
     def close(self) -> None:
         """Close the completion panel."""
         _PanelCompletion(self.view).close()
 
+    @staticmethod
+    def _max_fps() -> float:
+        return clamp(get_plugin_setting_dotted("settings.panel_completion_max_fps", 20), 1, 60)
+
 
 class _PanelCompletion:
     def __init__(self, view: sublime.View) -> None:
@@ -148,28 +305,51 @@ class _PanelCompletion:
 
     @property
     def completion_content(self) -> str:
-        completions = self._synthesize(self.completion_manager.completions)
-
-        return load_resource_template("panel_completion.md.jinja").render(
+        """The HTML content of the completion panel."""
+        if not (window := self.view.window()):
+            return ""
+
+        # the same dummy view which `mdpopups` uses to convert markdown for HTML sheets
+        dummy_view = window.create_output_panel("mdpopups-dummy", unlisted=True)
+        completions = self.completion_manager.ranked_completions()
+        header = load_resource_template("panel_completion.md.jinja", keep_trailing_newline=True).render(
             close_url=sublime.command_url("copilot_close_panel_completion", {"view_id": self.view.id()}),
             is_waiting=self.completion_manager.is_waiting,
-            sections=[
-                {
-                    "accept_url": sublime.command_url(
-                        "copilot_accept_panel_completion_shim",
-                        {"view_id": self.view.id(), "completion_index": index},
-                    ),
-                    "code": fix_completion_syntax_highlight(
+            unique_solutions=len(completions),
+            total_solutions=self.completion_manager.completion_target_count,
+        )
+        return "".join((
+            mdpopups.md2html(dummy_view, header),
+            *(self._render_section(dummy_view, index, completion) for index, completion in completions),
+        ))
+
+    def _render_section(self, dummy_view: sublime.View, index: int, completion: CopilotPayloadPanelSolution) -> str:
+        """Renders a completion into HTML. The result is cached since a completion never changes."""
+        section_html_cache = self.completion_manager.section_html_cache
+        if (cached := section_html_cache.get(index)) is not None:
+            Metrics.increase("panel_completion.section_cache.hits")
+            return cached
+        Metrics.increase("panel_completion.section_cache.misses")
+
+        markdown = load_resource_template("panel_completion_section.md.jinja", keep_trailing_newline=True).render(
+            section={
+                "accept_url": sublime.command_url(
+                    "copilot_accept_panel_completion_shim",
+                    {"view_id": self.view.id(), "completion_index": index},
+                ),
+                "code_html": HighlightCache.highlight(
+                    dummy_view,
+                    fix_completion_syntax_highlight(
                         self.view,
                         completion["region"][1],
                         self._prepare_popup_code_display_text(completion["displayText"]),
                     ),
-                    "lang": get_view_language_id(self.view, completion["region"][1]),
-                }
-                for index, completion in completions
-            ],
-            total_solutions=self.completion_manager.completion_target_count,
+                    get_view_language_id(self.view, completion["region"][1]),
+                ),
+            },
         )
+        html = section_html_cache[index] = mdpopups.md2html(dummy_view, markdown)
+        return html
 
     def open(self) -> None:
         window = self.view.window()
@@ -193,7 +373,7 @@ class _PanelCompletion:
         if not isinstance(sheet, sublime.HtmlSheet):
             return
 
-        mdpopups.update_html_sheet(sheet=sheet, contents=self.completion_content, md=True)
+        mdpopups.update_html_sheet(sheet=sheet, contents=self.completion_content, md=False, wrapper_class="wrapper")
 
     def close(self) -> None:
         window = self.view.window()
@@ -205,6 +385,8 @@ class _PanelCompletion:
             return
 
         sheet.close()
+        unregister_sheet(sheet.id())
+        self.completion_manager.sheet_id = -1
         self.completion_manager.is_visible = False
         if self.completion_manager.original_layout:
             window.set_layout(self.completion_manager.original_layout)  # type: ignore
@@ -226,18 +408,6 @@ class _PanelCompletion:
 
         return display_text
 
-    @staticmethod
-    def _synthesize(
-        completions: Iterable[CopilotPayloadPanelSolution],
-    ) -> list[tuple[int, CopilotPayloadPanelSolution]]:
-        """Return sorted-by-`score` completions in the form of `[(completion_index, completion), ...]`."""
-        return sorted(
-            # note that we must keep completion's original index
-            unique_everseen(enumerate(completions), key=lambda pair: pair[1]["completionText"]),
-            key=lambda pair: pair[1]["score"],
-            reverse=True,
-        )
-
     def _open_in_group(self, window: sublime.Window, group_id: int) -> None:
         self.completion_manager.group_id = group_id
 
@@ -246,9 +416,11 @@ class _PanelCompletion:
             window=window,
             name="Panel Completions",
             contents=self.completion_content,
-            md=True,
+            md=False,
             flags=sublime.TRANSIENT,
+            wrapper_class="wrapper",
         )
+        register_sheet(sheet)
         self.completion_manager.sheet_id = sheet.id()
 
     def _open_in_side_by_side(self, window: sublime.Window) -> None:
@@ -1,19 +1,20 @@
 from __future__ import annotations
 
 import contextlib
+import itertools
 import os
 import sys
-import threading
 from collections.abc import Callable, Generator, Iterable
 from functools import wraps
-from typing import Any, Mapping, Sequence, TypeVar, Union, cast
+from typing import Any, Generic, Mapping, Sequence, TypeVar, Union, cast
 
 import sublime
 from LSP.plugin.core.sessions import Session
 from LSP.plugin.core.types import basescope2languageid
-from more_itertools import first, first_true
+from more_itertools import first
 
 from .constants import COPILOT_VIEW_SETTINGS_PREFIX, PACKAGE_NAME
+from .metrics import Metrics
 from .types import T_Callable
 
 _T = TypeVar("_T")
@@ -57,30 +58,31 @@ def clamp(val: _T_Number, min_val: _T_Number | None = None, max_val: _T_Number |
     return val
 
 
-def debounce(time_s: float = 0.3) -> Callable[[T_Callable], T_Callable]:
+def debounce(time_s: float | Callable[[], float] = 0.3) -> Callable[[T_Callable], T_Callable]:
     """
     Debounce a function so that it's called after `time_s` seconds.
     If it's called multiple times in the time frame, it will only run the last call.
 
-    Taken and modified from https://github.com/salesforce/decorator-operations
+    If `time_s` is a callable, it's called to decide the delay whenever the function is called.
+    Calls are scheduled on ST's async thread so that no thread is created for each call.
     """
 
     def decorator(func: T_Callable) -> T_Callable:
+        generations = itertools.count(1)
+
         @wraps(func)
         def debounced(*args: Any, **kwargs: Any) -> None:
-            def call_function() -> Any:
-                delattr(debounced, "_timer")
-                return func(*args, **kwargs)
-
-            timer: threading.Timer | None = getattr(debounced, "_timer", None)
-            if timer is not None:
-                timer.cancel()
+            def call_function() -> None:
+                # only the last call is effective
+                if getattr(debounced, "_generation") == generation:
+                    func(*args, **kwargs)
 
-            timer = threading.Timer(time_s, call_function)
-            timer.start()
-            setattr(debounced, "_timer", timer)
+            generation = next(generations)
+            setattr(debounced, "_generation", generation)
+            delay_s = time_s() if callable(time_s) else time_s
+            sublime.set_timeout_async(call_function, int(delay_s * 1000))
 
-        setattr(debounced, "_timer", None)
+        setattr(debounced, "_generation", 0)
         return cast(T_Callable, debounced)
 
     return decorator
@@ -91,16 +93,98 @@ def drop_falsy(iterable: Iterable[_T | None]) -> Generator[_T, None, None]:
     yield from filter(None, iterable)
 
 
+class _ObjectIndex(Generic[_T]):
+    """
+    An `id -> object` index for ST windows, views and sheets.
+
+    The index is kept up to date by event listeners via `add()`/`discard()`.
+    A lookup is O(1) and only falls back to rescanning all objects when the ID is missing or stale.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        scan: Callable[[], Iterable[_T]],
+        get_id: Callable[[_T], int],
+        is_alive: Callable[[_T], bool],
+    ) -> None:
+        self._name = name
+        self._scan = scan
+        self._get_id = get_id
+        self._is_alive = is_alive
+        self._objects: dict[int, _T] = {}
+
+    def add(self, obj: _T) -> None:
+        self._objects[self._get_id(obj)] = obj
+
+    def discard(self, id: int) -> None:
+        self._objects.pop(id, None)
+
+    def find(self, id: int) -> _T | None:
+        if (obj := self._objects.get(id)) is not None and self._is_alive(obj):
+            Metrics.increase(f"{self._name}.hits")
+            return obj
+
+        Metrics.increase(f"{self._name}.rescans")
+        # replace the whole dict so that concurrent lookups never see a half-built index
+        self._objects = {self._get_id(obj): obj for obj in self._scan()}
+        return self._objects.get(id)
+
+
+_window_index = _ObjectIndex(
+    "object_index.window",
+    scan=all_windows,
+    get_id=lambda window: window.id(),
+    is_alive=lambda window: window.is_valid(),
+)
+_view_index = _ObjectIndex(
+    "object_index.view",
+    scan=lambda: all_views(include_transient=True),
+    get_id=lambda view: view.id(),
+    is_alive=lambda view: view.is_valid(),
+)
+_sheet_index = _ObjectIndex(
+    "object_index.sheet",
+    scan=lambda: all_sheets(include_transient=True),
+    get_id=lambda sheet: sheet.id(),
+    is_alive=lambda sheet: sheet.window() is not None,
+)
+
+
 def find_sheet_by_id(id: int) -> sublime.Sheet | None:
-    return first_true(all_sheets(include_transient=True), pred=lambda sheet: sheet.id() == id)
+    return _sheet_index.find(id)
 
 
 def find_view_by_id(id: int) -> sublime.View | None:
-    return first_true(all_views(include_transient=True), pred=lambda view: view.id() == id)
+    return _view_index.find(id)
 
 
 def find_window_by_id(id: int) -> sublime.Window | None:
-    return first_true(all_windows(), pred=lambda window: window.id() == id)
+    return _window_index.find(id)
+
+
+def register_sheet(sheet: sublime.Sheet) -> None:
+    _sheet_index.add(sheet)
+
+
+def register_view(view: sublime.View) -> None:
+    _view_index.add(view)
+
+
+def register_window(window: sublime.Window) -> None:
+    _window_index.add(window)
+
+
+def unregister_sheet(sheet_id: int) -> None:
+    _sheet_index.discard(sheet_id)
+
+
+def unregister_view(view_id: int) -> None:
+    _view_index.discard(view_id)
+
+
+def unregister_window(window_id: int) -> None:
+    _window_index.discard(window_id)
 
 
 def is_active_view(obj: Any) -> bool:
@@ -0,0 +1,116 @@
+"""
+Benchmarks `CopilotIgnoreMatcher` against calling `wcmatch.glob.globmatch()` per check.
+
+It checks 100k paths against a 500-line `.copilotignore` and verifies that both decide the same.
+The matcher module doesn't depend on Sublime Text, so this runs with a plain Python which has `wcmatch`:
+
+    uv run python scripts/benchmark_copilotignore.py
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import random
+import sys
+import time
+from pathlib import Path, PurePath
+
+from wcmatch import glob
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+FOLDER = str(PurePath("/project"))
+
+
+def load_matcher_class() -> type:
+    # the module is loaded by its path since importing the `plugin` package requires Sublime Text
+    spec = importlib.util.spec_from_file_location("copilotignore", PROJECT_ROOT / "plugin/copilotignore.py")
+    assert spec and spec.loader
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.CopilotIgnoreMatcher
+
+
+def make_patterns(rng: random.Random, count: int) -> list[str]:
+    kinds = (
+        lambda i: f"*.ext{i}",
+        lambda i: f"dir{i}/**",
+        lambda i: f"**/generated{i}/*.js",
+        lambda i: f"src/module{i}/*.py",
+        lambda i: f"file{i}.[ch]",
+        lambda i: f"docs/**/draft{i}?.md",
+    )
+    return [rng.choice(kinds)(i) for i in range(count)]
+
+
+def make_paths(rng: random.Random, count: int, pattern_count: int) -> list[str]:
+    paths: list[str] = []
+    for i in range(count):
+        n = rng.randrange(pattern_count * 2)  # about half of the names have no corresponding pattern
+        parts = rng.choice((
+            ("src", f"module{n}", f"file{i}.py"),
+            (f"dir{n}", "sub", f"file{i}.txt"),
+            ("web", f"generated{n}", f"bundle{i}.js"),
+            ("docs", "notes", f"draft{n}a.md"),
+            (f"file{n}.c",),
+            ("lib", f"file{i}.ext{n}"),
+        ))
+        paths.append(str(PurePath(FOLDER, *parts)))
+    return paths
+
+
+def globmatch_any(patterns: dict[str, list[str]], file_path: str) -> bool:
+    """How `CopilotIgnore.matches_any_pattern()` used to decide."""
+    path = Path(file_path)
+    for folder, folder_patterns in patterns.items():
+        try:
+            relative_path = path.relative_to(folder).as_posix()
+        except ValueError:
+            continue
+        if glob.globmatch(relative_path, folder_patterns, flags=glob.GLOBSTAR):
+            return True
+    return False
+
+
+def timed(label: str, func, paths: list[str]) -> list[bool]:
+    start = time.perf_counter()
+    decisions = [func(path) for path in paths]
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed:8.3f} s  ({elapsed / len(paths) * 1e6:7.2f} µs/path)")
+    return decisions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--paths", type=int, default=100_000, help="the number of paths to check")
+    parser.add_argument("--patterns", type=int, default=500, help="the number of lines in .copilotignore")
+    parser.add_argument("--baseline-paths", type=int, default=200, help="the number of paths for globmatch")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    patterns = {FOLDER: make_patterns(rng, args.patterns)}
+    paths = make_paths(rng, args.paths, args.patterns)
+    print(f"{len(paths)} paths against {args.patterns} patterns")
+
+    matcher_class = load_matcher_class()
+    start = time.perf_counter()
+    matcher = matcher_class(patterns)
+    print(f"{'compile':<28} {time.perf_counter() - start:8.3f} s")
+
+    cold = timed("matcher (cold)", matcher.matches, paths)
+    warm = timed("matcher (cached decisions)", matcher.matches, paths)
+    baseline_paths = paths[: args.baseline_paths]
+    baseline = timed(
+        f"globmatch ({len(baseline_paths)} paths)", lambda path: globmatch_any(patterns, path), baseline_paths
+    )
+
+    print(f"ignored: {sum(cold)} of {len(paths)}")
+    if cold != warm or cold[: len(baseline)] != baseline:
+        print("error: decisions differ from globmatch", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())